@@ -3,54 +3,762 @@ Created on Apr 28, 2013
 
 @author: ehsan
 '''
-from io import IOBase
+from array import array
+import bisect
 from StringIO import StringIO
-import pprint
+import marshal
+import mmap
+import os
 import sys
 import re
-from configobj import ParseError
-from reportlab.lib.validators import isCallable
+import struct
+import thread
+import time
+from UserDict import DictMixin
+import zlib
+# The modules only some of the methods need (io, multiprocessing, pprint, threading, xml) are imported on first use, to keep the import of
+# this module cheap for short-lived processes.
+
+_REFERENCE_PATTERN = re.compile(r'\$\{([^}]+)\}')  # Matches a ${reference-key} in a property value.
+_LINE_BREAK_PATTERN = re.compile(r'\r\n|[\r\n]')
+_SEPARATOR_PATTERN = re.compile(r'[=:]')
+_ENTRY_PATTERN = re.compile(r'(?:[^\\=:]|\\.)*[=:]', re.DOTALL)    # Key up to the first unescaped separator.
+_ESCAPE_PATTERN = re.compile(r'\\(u[0-9a-fA-F]{4}|.)', re.DOTALL)
+_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f'}
+_BLOCK_SIZE = 1 << 16   # Size of the blocks the input streams are read in.
+_MISSING = object()  # Marks a key missing from a dictionary, whose values may be None.
+_SORTED_INSERT_LIMIT = 64    # New keys inserted in place in the sorted keys of the namespace queries, beyond which they are sorted again.
+_INDEX_PATCH_LIMIT = 256    # Logged changes of a property list, re-indexed key by key by the lookup indexes, see Properties.__patchIndex.
+_SNAPSHOT_FORMAT = 'properties-snapshot-1'  # Identifies the layout of the snapshot files, see :py:func:`Properties.storeSnapshot`.
+_STORE_ESCAPE_PATTERN = re.compile(u'[\\\\=:#!\t\n\r\f]|[^\x20-\x7e]|^ | \\Z')    # Characters escaped by Properties.store.
+_STORE_ESCAPE_BYTES_PATTERN = re.compile('[\\\\=:#!\t\n\r\f]|[\x00-\x1f\x7f]|^ | \\Z')  # Bytes of a str escaped by Properties.store.
+_STORE_ESCAPES = {'\\': '\\\\', '=': '\\=', ':': '\\:', '#': '\\#', '!': '\\!', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\f': '\\f'}
+_DURATION_PATTERN = re.compile(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*(ms|s|m|h|d|w)?', re.IGNORECASE)
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+_SIZE_PATTERN = re.compile(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*(?:([kmgtp])i?)?b?\s*$', re.IGNORECASE)
+_SIZE_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40, 'p': 1 << 50}
+_BOOLEANS = {'true': True, 'yes': True, 'on': True, '1': True, 'false': False, 'no': False, 'off': False, '0': False}
+_SHARED_MAGIC = 'propshm1'  # Identifies the layout of the shared properties files, see :py:func:`Properties.publish`.
+_SHARED_HEADER = struct.Struct('<8sIII')    # Magic, number of entries, size of the hash index, reserved.
+_SHARED_ENTRY = struct.Struct('<7I')    # Offsets and lengths of the key, value and expanded value, flags.
+_SHARED_SLOT = struct.Struct('<I')      # Hash index slot, 1 + the entry of the key, 0 if empty.
+_SHARED_ABSENT = 0xffffffff     # Offset of an expanded value which is not published.
+_XML_HEADER = '<?xml version="1.0" encoding="%s" standalone="no"?>\n<!DOCTYPE properties SYSTEM "http://java.sun.com/dtd/properties.dtd">\n'
+_statistics = None  # PropertiesStatistics collecting the statistics of all the properties, None while disabled.
+_mutationCount = 0  # Number of mutations of all the Properties instances, lets the caches skip revalidation while nothing changes.
+_mutationLock = thread.allocate_lock()     # Serializes the increments of _mutationCount, see _nextVersion.
 
 """
-TODO:   Load/Store XML
-        Use proper StringIO, BaseIO checks in the list and store methods.
-        Get Name Space Property with and without expanded.
+TODO:   Use proper StringIO, BaseIO checks in the list and store methods.
 """
+class PropertiesError(Exception):
+    """
+    Base class of the errors raised by the properties module.
+    """
+
+class ParseError(PropertiesError, SyntaxError):
+    """
+    Raised when a property list can not be parsed. It is a SyntaxError, as was the configobj ParseError this module used to raise.
+    """
+
+class CyclicReferenceError(PropertiesError, ValueError):
+    """
+    Raised when expanding a property runs into a reference cycle, e.g. a=${b} and b=${a}. The :attr:`cycle` holds the keys forming the cycle,
+    starting and ending with the same key.
+    """
+
+    def __init__(self, cycle):
+        ValueError.__init__(self, 'Cyclic property reference: ' + ' -> '.join(cycle))
+        self.cycle = cycle
+
+class UnresolvedReferenceError(PropertiesError, ValueError):
+    """
+    Raised by :py:func:`Properties.expandAll` when references can not be resolved. :attr:`cycles` lists the reference cycles found, each as
+    the list of keys forming it, and :attr:`dangling` lists the (key, reference-key) pairs whose reference-key does not exist.
+    """
+
+    def __init__(self, cycles, dangling):
+        messages = ['Cyclic property reference: ' + ' -> '.join(cycle) for cycle in cycles]
+        messages.extend('Dangling property reference: %s -> %s' % reference for reference in dangling)
+        ValueError.__init__(self, '\n'.join(messages))
+        self.cycles = cycles
+        self.dangling = dangling
+
+class PropertiesDiff(tuple):
+    """
+    The keys added, changed and removed by :py:func:`Properties.reload`, each as a frozenset.
+    """
+    __slots__ = ()
+
+    def __new__(cls, added, changed, removed):
+        return tuple.__new__(cls, (added, changed, removed))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __repr__(self):
+        return 'PropertiesDiff(added=%r, changed=%r, removed=%r)' % self
+
+    added = property(lambda self: self[0])
+    changed = property(lambda self: self[1])
+    removed = property(lambda self: self[2])
+
+class PropertiesStatistics(object):
+    """
+    Counters and timings of the operations of all the properties, collected while enabled by :py:func:`Properties.enableStatistics`:
+    lookups and misses of :py:func:`Properties.getProperty` with the histogram of the depth in the defaults chain the keys are found at,
+    expansions and hits of the expanded cache with the depth of the nested references, conversions of the typed getters and hits of their
+    cache, and the parsed files with their number of lines and parse time. The counters are not synchronized, they are approximate when
+    several threads use properties. Hooks can be registered to be called on every event, see :py:func:`addHook`.
+    """
+
+    EVENTS = ('lookup', 'expansion', 'conversion', 'parse')
+
+    def __init__(self):
+        self.__hooks = dict((event, ()) for event in PropertiesStatistics.EVENTS)
+        self.reset()
+
+    def reset(self):
+        """
+        Sets all the counters and timings to zero, the hooks are kept.
+        """
+        self.lookups = 0
+        self.misses = 0
+        self.chainDepths = {}       # depth -> number of lookups resolved at that depth, 0 being the local property list.
+        self.expansions = 0
+        self.expansionHits = 0
+        self.nestedExpansions = 0   # Expansions of the keys referenced by the expanded values.
+        self.maxExpansionDepth = 0
+        self.conversions = 0
+        self.conversionHits = 0
+        self.parses = 0
+        self.parsedLines = 0
+        self.parseTime = 0.0
+
+    @property
+    def expansionHitRate(self):
+        """
+        The fraction of the expansions served by the expanded cache.
+        """
+        return float(self.expansionHits) / self.expansions if self.expansions else 0.0
+
+    @property
+    def conversionHitRate(self):
+        """
+        The fraction of the conversions served by the conversion cache.
+        """
+        return float(self.conversionHits) / self.conversions if self.conversions else 0.0
+
+    def getStatistics(self):
+        """
+        Returns a dictionary with a copy of all the counters and timings.
+        """
+        return {'lookups': self.lookups, 'misses': self.misses, 'chainDepths': dict(self.chainDepths), 'expansions': self.expansions,
+                'expansionHits': self.expansionHits, 'expansionHitRate': self.expansionHitRate, 'nestedExpansions': self.nestedExpansions,
+                'maxExpansionDepth': self.maxExpansionDepth, 'conversions': self.conversions, 'conversionHits': self.conversionHits,
+                'conversionHitRate': self.conversionHitRate, 'parses': self.parses, 'parsedLines': self.parsedLines,
+                'parseTime': self.parseTime}
+
+    def addHook(self, event, hook):
+        """
+        Registers :param hook to be called on every :param event:
+        'lookup': hook(key, depth), depth being None if the key is not found.
+        'expansion': hook(key, depth, hit), depth being the number of expansions the key is nested in, hit True if the value was cached.
+        'conversion': hook(key, conversion, hit), conversion being e.g. 'int' or 'duration'.
+        'parse': hook(name, lines, seconds), name being the name of the parsed file or None.
+        """
+        if event not in self.__hooks:
+            raise ValueError('Unknown event %s, must be one of %s.' % (event, ', '.join(PropertiesStatistics.EVENTS)))
+        self.__hooks[event] += (hook,)
+
+    def removeHook(self, event, hook):
+        """
+        Unregisters a hook registered by :py:func:`addHook`.
+        """
+        hooks = list(self.__hooks[event])
+        hooks.remove(hook)
+        self.__hooks[event] = tuple(hooks)
+
+    def _recordLookup(self, key, depth):
+        self.lookups += 1
+        if depth is None:
+            self.misses += 1
+        else:
+            self.chainDepths[depth] = self.chainDepths.get(depth, 0) + 1
+        for hook in self.__hooks['lookup']:
+            hook(key, depth)
+
+    def _recordExpansion(self, key, depth, hit):
+        self.expansions += 1
+        if hit:
+            self.expansionHits += 1
+        if depth:
+            self.nestedExpansions += 1
+            self.maxExpansionDepth = max(self.maxExpansionDepth, depth)
+        for hook in self.__hooks['expansion']:
+            hook(key, depth, hit)
+
+    def _recordConversion(self, key, conversion, hit):
+        self.conversions += 1
+        if hit:
+            self.conversionHits += 1
+        for hook in self.__hooks['conversion']:
+            hook(key, conversion, hit)
+
+    def _recordParse(self, name, lines, seconds):
+        self.parses += 1
+        self.parsedLines += lines
+        self.parseTime += seconds
+        for hook in self.__hooks['parse']:
+            hook(name, lines, seconds)
+
+
+class PropertiesParser(object):
+    """
+    Incremental parser of the property list format. The input is pushed to the parser in chunks of any size as it arrives, e.g. from a
+    non-blocking socket or an event loop callback, and each call returns the properties completed by the chunk, so that the caller is never
+    blocked waiting for the rest of the input. Use :py:func:`Properties.loadEntries` to store the parsed properties, and
+    :py:class:`MergingPropertiesParser` to parse several inputs concurrently and merge them in the precedence order of their sources rather
+    than in the order they complete. :py:func:`Properties.iterParse` is built on top of this class.
+    """
+
+    def __init__(self, unescape=False):
+        """
+        Creates a parser at the beginning of a property list.
+        :param unescape: If True then the escape sequences in the keys and values are replaced, see :py:func:`Properties.load`.
+        """
+        self.__unescapeEntries = unescape
+        self.__pending = ''         # Incomplete last line of the input fed so far.
+        self.__accLine = []         # Line accumulator for multiline properties.
+        self.__lineNumber = 0       # Number of lines parsed so far.
+        self.__startLineNumber = 0  # Line the property being accumulated starts at.
+        self.__error = None         # ParseError raised by the next call, see :py:func:`__parseLines`.
+
+    @property
+    def lineNumber(self):
+        """
+        The number of complete lines parsed so far.
+        """
+        return self.__lineNumber
+
+    def feed(self, data):
+        """
+        Parses the chunk :param data of the property list, a str or unicode, and returns the list of (key, value, lineNumber) tuples of the
+        properties it completes, see :py:func:`Properties.iterParse`. The incomplete last line of the chunk is kept until the next chunk.
+        Raises ParseError if a property does not conform to the property line rule. The properties before the malformed one are returned
+        first, the error is then raised by the next call.
+        """
+        if self.__error is not None:
+            raise self.__error
+        if not data:
+            return []
+        text = self.__pending + data
+        if isinstance(text, unicode):   # unicode.splitlines also breaks on \\f, \\x1c etc., which are not line terminators here.
+            if text[-1] == u'\r':  # Keep a trailing \\r which may be the first half of \\r\\n, as below.
+                lines = _LINE_BREAK_PATTERN.split(text[:-1])
+                self.__pending = lines.pop() + u'\r'
+            else:
+                lines = _LINE_BREAK_PATTERN.split(text)
+                self.__pending = lines.pop()
+        else:
+            lines = text.splitlines()
+            last = text[-1]
+            if last == '\n':
+                self.__pending = ''
+            else:   # Keep the incomplete last line, and a trailing \\r which may be the first half of \\r\\n.
+                self.__pending = lines.pop() + last if last == '\r' else lines.pop()
+        return self.__parseLines(lines)
+
+    def feedLines(self, lines):
+        """
+        Parses :param lines, one or more complete lines with or without the terminator of the last one, and returns the list of (key, value,
+        lineNumber) tuples of the properties they complete, see :py:func:`feed`.
+        """
+        if self.__error is not None:
+            raise self.__error
+        lines = _LINE_BREAK_PATTERN.split(self.__pending + lines)
+        self.__pending = ''
+        if not lines[-1]:   # The lines end with a line terminator.
+            lines.pop()
+        return self.__parseLines(lines)
+
+    def close(self):
+        """
+        Parses the last line of the property list, which may have no line terminator, and returns the list of (key, value, lineNumber) tuples
+        of the properties it completes. Raises ParseError if the property list ends in the middle of a multiline property.
+        """
+        if self.__error is not None:
+            raise self.__error
+        pending = self.__pending
+        self.__pending = ''
+        if pending.endswith('\r'):     # A complete line, empty or not, whose \r was kept in case it was the first half of \r\n.
+            entries = self.__parseLines([pending[:-1]])
+        else:
+            entries = self.__parseLines([pending]) if pending else []
+        if self.__accLine:
+            raise ParseError('Invalid termination of stream, was expecting more.')
+        return entries
+
+    def __parseLines(self, lines):
+        """
+        Returns the list of (key, value, lineNumber) tuples of the properties completed by the complete :param lines, which are without their
+        terminators. If a line can not be parsed then the properties before it are returned and the ParseError is kept for the next call, so
+        that no property is lost.
+        """
+        entries = []
+        unescape = self.__unescapeEntries
+        accLine = self.__accLine
+        lineNumber = self.__lineNumber
+        startLineNumber = self.__startLineNumber
+        try:
+            for line in lines:
+                lineNumber += 1
+                if not line or line.isspace():  # Ignore empty lines and lines comprising of whitespaces only, but, as in java.util.Properties,
+                    if not accLine:             # they end the multiline property being accumulated.
+                        continue
+                    line = ''
+                elif line[0] in '#!':   # Ignore comments (#,!).
+                    continue
+                line = line.strip()
+                if '\\' not in line and not accLine:   # Fast path, a single line property without escapes.
+                    i = line.find('=')
+                    j = line.find(':')
+                    if j != -1 and (j < i or i == -1):
+                        i = j
+                    if i <= 0:
+                        raise ParseError('Unable to parse property at line %d. Should conform to the property line rule.' % lineNumber)
+                    key, value = line[:i].rstrip(), line[i+1:].lstrip()
+                    startLineNumber = lineNumber
+                elif (len(line) - len(line.rstrip('\\'))) % 2 == 0:  # No trailing \ or even number of trailing \, we have read one complete property.
+                    if accLine:
+                        accLine.append(line)
+                        line = ''.join(accLine)     # Creating a complete property line with key and value.
+                        accLine = []
+                    else:
+                        startLineNumber = lineNumber
+                    key, value = PropertiesParser.__getPropertyFromStringLine(line, startLineNumber)
+                else:
+                    if not accLine:
+                        startLineNumber = lineNumber
+                    accLine.append(line[:-1].strip())   # Strip down white spaces before line break escape \\n
+                    continue
+                if unescape:
+                    key, value = PropertiesParser.__unescape(key), PropertiesParser.__unescape(value)
+                if key.__class__ is str:    # The same keys are shared by all the properties loading them.
+                    key = intern(key)
+                entries.append((key, value, startLineNumber))
+        except ParseError, e:
+            if not entries:
+                raise
+            self.__error = e
+        finally:
+            self.__accLine = accLine
+            self.__lineNumber = lineNumber
+            self.__startLineNumber = startLineNumber
+        return entries
+
+    @staticmethod
+    def __unescape(s):
+        """
+        Returns :param s with the .properties escape sequences (\\t, \\n, \\r, \\f, \\uXXXX and \\ followed by any other character) replaced.
+        """
+        if '\\' not in s:
+            return s
+        return _ESCAPE_PATTERN.sub(PropertiesParser.__unescapeMatch, s)
+
+    @staticmethod
+    def __unescapeMatch(match):
+        escaped = match.group(1)
+        if escaped[0] == 'u':
+            if len(escaped) != 5:
+                raise ParseError('Malformed \\uxxxx encoding.')
+            code = int(escaped[1:], 16)
+            return chr(code) if code < 0x80 else unichr(code)
+        return _ESCAPES.get(escaped, escaped)
+
+    @staticmethod
+    def __getPropertyFromStringLine(s, lineNumber):
+        """
+        Returns the (key, value) tuple after parsing the input string :param s. The method assumes that the given string conforms to the rules for property.
+        If the given string does not conforms to the property rules then throws a parse exception.
+        :param s: The string to parse the property. This string should conforms to the rules of property.
+        :param lineNumber: The line number the property starts at, reported in the parse exception.
+        """
+        if '\\' in s:     # The separator may be escaped, \\= needs to be parsed as \\ and = and not \ and \=.
+            match = _ENTRY_PATTERN.match(s)
+            i = match.end() - 1 if match else 0
+        else:
+            match = _SEPARATOR_PATTERN.search(s)
+            i = match.start() if match else 0
+        if i == 0:  # No key before the separator, the property does not conforms with the rules.
+            raise ParseError('Unable to parse property at line %d. Should conform to the property line rule.' % lineNumber)
+        return (s[:i].strip(), s[i+1:].strip())
+
+
+def _nextVersion():
+    """
+    Records a mutation and returns the new version of the mutated properties or property list, unique across all of them. The increment is
+    atomic, an increment lost between two writer threads could let a reader skip the revalidation of its caches.
+    """
+    global _mutationCount
+    with _mutationLock:
+        _mutationCount += 1
+        return _mutationCount
+
+
+class _PropertyDict(dict):
+    """
+    Local property list of a :py:class:`Properties`, a dictionary that records its mutations. The changes made to it directly, rather than
+    through :py:func:`Properties.setProperty` or :py:func:`Properties.load`, are thus detected by the lookup indexes and the expansion caches.
+    """
+
+    __slots__ = ('__version',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.__version = 0
+
+    def __reduce__(self):
+        return (_PropertyDict, (dict(self),))
+
+    def stamp(self):
+        """
+        Returns the version of the dictionary, which changes on every mutation.
+        """
+        return self.__version
+
+    def __touch(self):
+        self.__version = _nextVersion()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.__touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.__touch()
+
+    def clear(self):
+        dict.clear(self)
+        self.__touch()
+
+    def pop(self, *args):
+        try:
+            return dict.pop(self, *args)
+        finally:
+            self.__touch()
+
+    def popitem(self):
+        try:
+            return dict.popitem(self)
+        finally:
+            self.__touch()
+
+    def setdefault(self, key, default=None):
+        try:
+            return dict.setdefault(self, key, default)
+        finally:
+            self.__touch()
+
+    def update(self, *args, **kwargs):
+        try:
+            dict.update(self, *args, **kwargs)
+        finally:
+            self.__touch()
+
+
+class MergingPropertiesParser(object):
+    """
+    Parses the property lists of several sources pushed concurrently, e.g. fetched from several servers at once, with one
+    :py:class:`PropertiesParser` per source, and merges them in the precedence order of the sources, whatever the order their chunks arrive
+    and complete in.
+    """
+
+    def __init__(self, sources, unescape=False):
+        """
+        Creates the parsers.
+        :param sources: The number of sources. The properties of a source override the ones of the sources before it, see
+        :py:func:`Properties.mergeProperties`.
+        :param unescape: If True then the escape sequences in the keys and values are replaced, see :py:func:`Properties.load`.
+        """
+        self.__parsers = [PropertiesParser(unescape) for _ in xrange(sources)]
+        self.__properties = [Properties() for _ in xrange(sources)]
+        self.__open = set(xrange(sources))     # The sources not closed yet.
+
+    def feed(self, source, data):
+        """
+        Parses the chunk :param data of the property list of the :param source (index), see :py:func:`PropertiesParser.feed`.
+        """
+        self.__properties[source].loadEntries(self.__parsers[source].feed(data))
+
+    def close(self, source):
+        """
+        Parses the end of the property list of the :param source (index), see :py:func:`PropertiesParser.close`.
+        """
+        self.__properties[source].loadEntries(self.__parsers[source].close())
+        self.__open.discard(source)
+
+    def merge(self):
+        """
+        Returns the properties of all the sources merged into a single properties, see :py:func:`Properties.mergeProperties`. Raises
+        ValueError if a source is not closed yet.
+        """
+        if self.__open:
+            raise ValueError('Sources %s are not closed.' % ', '.join(str(source) for source in sorted(self.__open)))
+        return Properties.mergeProperties(self.__properties)
+
+
 class Properties(object):
     """
     Properties represents a persistent list of properties (key/value pairs of string). The properties can be read from and written to a stream.
     The values can reference the properties in the values using ${referencing-key}, the properties in the local property list can refer to the
     property defined in the default property list and vice versa.
+    The instances have no attribute dictionary and allocate their caches on first use, so that many small properties sharing the same default
+    properties stay cheap, see also :py:class:`OverlayProperties`.
     """
 
+    __slots__ = ('__version', '__defaults', '__properties', '__changes', '__index', '__indexStamp', '__indexClock', '__sortedKeys',
+                 '__sortedKeysIndex', '__templates', '__expanded', '__dependents', '__expandedStamp', '__expandedClock', '__converted', '__source',
+                 '__listeners', '__weakref__')
+
     def __init__(self, defaultProperty=None):
         """
         Creates an empty property list with defaults.
        :param defaultPropertyList: The property list that is to be used as the default property list, by default there are no default properties.
         """
+        self.__version = 0          # Incremented on every mutation, so that dependent properties can detect changes.
         self.defaults = defaultProperty
         self.properties = {}
-    
-    def __getDefaultProperty(self, key):
+        self.__changes = None       # ([layer stamps], [keys put between them]) of the last puts, see :py:func:`__logChange`.
+        self.__index = None         # Flattened lookup index of the defaults chain, see :py:func:`__lookupIndex`.
+        self.__indexStamp = None    # Chain stamp against which the index was built.
+        self.__indexClock = -1      # Mutation count at which the index was last validated.
+        self.__sortedKeys = None    # Sorted keys of the index, for the namespace queries.
+        self.__sortedKeysIndex = None   # Index the sorted keys belong to.
+        self.__templates = None     # key -> (raw value, compiled segments) for the values containing references.
+        self.__expanded = None      # key -> expanded value cache, see :py:func:`getExpandedProperty`. Allocated by :py:func:`__validateExpanded`.
+        self.__dependents = None    # key -> set of keys whose cached expansion referenced it.
+        self.__expandedStamp = ()   # Defaults stamp against which the expanded cache was filled.
+        self.__expandedClock = -1   # Mutation count at which the expanded cache was last validated.
+        self.__converted = None     # key -> {type: converted value}, see :py:func:`__getConverted`. Invalidated along with the expanded cache.
+        self.__source = None        # File the properties were created from, see :py:func:`reload`.
+        self.__listeners = ()       # Callbacks notified of the changes made by :py:func:`reload`.
+
+    @property
+    def defaults(self):
+        """
+        The default properties, searched for the keys that are not in the local property list. None if there are no default properties.
+        """
+        return self.__defaults
+
+    @defaults.setter
+    def defaults(self, defaultProperty):
+        self.__defaults = defaultProperty
+        self.__touch()
+
+    @property
+    def properties(self):
+        """
+        The local property list (dictionary). Its direct mutations are detected, but invalidate the whole lookup index and expansion cache,
+        whereas :py:func:`setProperty` and :py:func:`load` update them key by key. An assigned dictionary is copied.
+        """
+        return self.__properties
+
+    @properties.setter
+    def properties(self, properties):
+        self.__properties = _PropertyDict(properties) if properties.__class__ is dict else properties
+        self.__expanded = None      # The expanded caches are reallocated, none of the cached expansions is valid anymore.
+        self.__touch()
+
+    def __touch(self):
+        """
+        Records a mutation of this properties. The versions are unique across all the properties, so that a properties replaced by another one
+        in a defaults chain is always detected.
+        """
+        self.__version = _nextVersion()
+
+    def __chainStamp(self):
+        """
+        Returns a stamp identifying the current state of this properties and its defaults chain.
+        """
+        return ((self,) + self.__layerStamp(),) + self.__defaultsStamp()
+
+    def __layerStamp(self):
+        """
+        Returns a stamp identifying the current state of this properties alone, i.e. its version and the stamp of its local property list.
+        """
+        return (self.__version,) + self.__viewStamp()
+
+    def __viewStamp(self):
+        """
+        Returns the stamp of the local property list, which changes along with its direct mutations, see :py:class:`_PropertyDict`, or, for a
+        view over other properties, along with them, see :py:class:`MergedProperties`. Returns an empty tuple for an untracked dictionary.
+        """
+        if self.__properties.__class__ is dict:
+            return ()
+        stamp = getattr(self.__properties, 'stamp', None)
+        return (stamp(),) if stamp is not None else ()
+
+    def _lookupIndexWithStamp(self):
+        """
+        Returns the lookup index, see :py:func:`__lookupIndex`, and the stamp of the state of the properties it was built for.
+        """
+        index = self.__lookupIndex()
+        return index, self.__indexStamp
+
+    def __lookupIndex(self):
+        """
+        Returns the flattened lookup index of this properties and its defaults chain, a dictionary mapping every key to the local property
+        dictionary of the topmost properties in the chain holding it. The index is built lazily, directly from the local property lists of the
+        chain, so that only the properties actually queried hold one. It is validated through the version counters: the keys put since in the
+        chain are re-indexed one by one, see :py:func:`__patchIndex`, and the index is rebuilt after any other change.
+        """
+        clock = _mutationCount
+        if self.__indexClock != clock:
+            stamp = self.__chainStamp()
+            if stamp != self.__indexStamp and not self.__patchIndex(stamp):
+                properties = self.__properties
+                if properties.__class__ is _PackedPropertyDict:     # Overlay, the index of the defaults is shared rather than copied.
+                    index = _OverlayIndex(self.__defaults.__lookupIndex() if self.__defaults is not None else {}, properties)
+                else:
+                    index = {}
+                    for properties in reversed(self.__layers()):
+                        index.update(dict.fromkeys(properties, properties))
+                self.__index = index
+            self.__indexStamp = stamp
+            self.__indexClock = clock
+        return self.__index
+
+    def __layers(self):
+        """
+        Returns the local property lists of this properties and its defaults chain, from the top to the bottom of the chain.
+        """
+        layers = []
+        layer = self
+        while layer is not None:
+            layers.append(layer.__properties)
+            layer = layer.__defaults
+        return layers
+
+    def __patchIndex(self, stamp):
+        """
+        Brings the lookup index up to date with the chain :param stamp by re-indexing only the keys put in the chain since the index was built,
+        as logged by :py:func:`__logChange`, rather than rebuilding it. Returns False if the index must be rebuilt instead, i.e. a properties was
+        replaced in or added to the chain, or a property list was otherwise changed, e.g. keys were removed or too many keys were put.
+        """
+        index = self.__index
+        indexStamp = self.__indexStamp
+        if index.__class__ is not dict or indexStamp is None or len(indexStamp) != len(stamp):
+            return False
+        changes = []
+        for depth, (old, new) in enumerate(zip(indexStamp, stamp)):
+            if old[0] is not new[0]:
+                return False
+            if old != new:
+                keys = new[0].__changedKeys(old[1:])
+                if keys is None:
+                    return False
+                changes.append((depth, keys))
+        layers = self.__layers()
+        depths = dict((id(properties), depth) for depth, properties in reversed(list(enumerate(layers))))
+        sortedKeys = self.__sortedKeys if self.__sortedKeysIndex is index else None
+        inserted = 0
+        for depth, keys in changes:
+            properties = layers[depth]
+            for key in keys:
+                holder = index.get(key)
+                if holder is None:
+                    if sortedKeys is not None:
+                        if inserted < _SORTED_INSERT_LIMIT:
+                            bisect.insort(sortedKeys, key)
+                            inserted += 1
+                        else:
+                            sortedKeys = self.__sortedKeys = self.__sortedKeysIndex = None
+                    index[key] = properties
+                elif holder is not properties and depths[id(holder)] > depth:  # The key now overrides the one of a deeper default properties.
+                    index[key] = properties
+        return True
+
+    def __logChange(self, before, keys):
+        """
+        Logs the :param keys just put in the local property list, changing the stamp of this properties from :param before, see
+        :py:func:`__layerStamp`. Only the last :py:data:`_INDEX_PATCH_LIMIT` consecutive puts are logged.
         """
-        Searches for the property key in the default property and recursively. The method return None if there is no default property.
-        :param key: The property key.
+        after = self.__layerStamp()
+        changes = self.__changes
+        if changes is None or changes[0][-1] != before:
+            self.__changes = ([before, after], [keys])
+        else:
+            stamps, puts = changes
+            stamps.append(after)
+            puts.append(keys)
+            if len(puts) > _INDEX_PATCH_LIMIT:
+                del stamps[0]
+                del puts[0]
+
+    def __changedKeys(self, stamp):
         """
-        if self.defaults:
-            return self.defaults.getProperty(key)
+        Returns the keys put in the local property list since this properties had the :param stamp, see :py:func:`__layerStamp`. Returns None
+        if the changes since were not all logged.
+        """
+        changes = self.__changes
+        if changes is None:
+            return None
+        stamps, puts = changes
+        if stamps[-1] != self.__layerStamp():
+            return None
+        for i in xrange(len(puts) - 1, -1, -1):
+            if stamps[i] == stamp:
+                return [key for keys in puts[i:] for key in keys]
         return None
     
+    def __namespaceKeys(self, prefix):
+        """
+        Returns the keys of this properties and its default properties starting with :param prefix, in sorted order. The keys are looked up by
+        binary search in the sorted keys of the lookup index, which are kept up to date along with the index.
+        """
+        index = self.__lookupIndex()
+        if index.__class__ is _OverlayIndex:    # The sorted keys of the shared default properties are merged with the few overrides.
+            keys = set(self.__defaults.__namespaceKeys(prefix)) if self.__defaults is not None else set()
+            keys.update(key for key in self.__properties if key.startswith(prefix))
+            return sorted(keys)
+        if self.__sortedKeysIndex is not index:
+            self.__sortedKeys = sorted(index)
+            self.__sortedKeysIndex = index
+        sortedKeys = self.__sortedKeys
+        start = bisect.bisect_left(sortedKeys, prefix)
+        end = start
+        while end < len(sortedKeys) and sortedKeys[end].startswith(prefix):
+            end += 1
+        return sortedKeys[start:end]
+
+    def getNamespaceProperties(self, namespace, expanded=False, stripNamespace=False):
+        """
+        Returns a dictionary containing the properties (key/values), including the ones of the default properties, in the :param namespace, i.e.
+        whose keys start with the namespace followed by a '.'. The cost of the query depends on the number of properties in the namespace rather
+        than on the total number of properties.
+        :param namespace: The namespace, e.g. 'db.primary' for the keys 'db.primary.host', 'db.primary.port' etc. An empty namespace selects all
+        the properties.
+        :param expanded: If True then return the expanded values, see :py:func:`getExpandedProperty`.
+        :param stripNamespace: If True then the namespace (and the '.' following it) is removed from the returned keys.
+        """
+        prefix = namespace + '.' if namespace and not namespace.endswith('.') else namespace
+        index = self.__lookupIndex()
+        namespaceProperties = {}
+        for key in self.__namespaceKeys(prefix):
+            value = index[key][key]
+            if expanded and value:
+                expandedValue = self.getExpandedProperty(key)
+                value = expandedValue if expandedValue is not None else value
+            namespaceProperties[key[len(prefix):] if stripNamespace else key] = value
+        return namespaceProperties
+
     def getAllProps(self):
         """
         Returns a dictionary containing all the properties (key/values) and all the properties of the default properties (recursive) that are not
-        in the current property object.
+        in the current property object. The returned dictionary is a copy, changing it does not change the properties.
         """
-        if self.defaults:
-            resDictionary = self.defaults.getAllProps()
-            resDictionary.update(self.properties)
-            return resDictionary
-        else:
-            return self.properties
+        return dict((key, properties[key]) for key, properties in self.__lookupIndex().iteritems())
     
     def __applyFormat(self, value, formatter):
         """
@@ -59,7 +767,7 @@ class Properties(object):
         :param formatter: formatter function to apply on the value before returning the result.
         """
         if formatter:
-            if isCallable(formatter):
+            if callable(formatter):
                 return formatter(value)
             else:
                 raise TypeError ('formatter is not callable.')
@@ -77,158 +785,1729 @@ class Properties(object):
         :param defaultValue: The default value to return if property key is not found. The default value for :param defaultValue is None.
         :param formatter: The formatter function to apply on the value before returning the result. By default there is no default formatter.
         """
-        if key in self.properties:
-            return self.__applyFormat(self.properties[key], formatter)
-        defaultPropertyValue = self.__getDefaultProperty(key)
-        if defaultPropertyValue:
-            return self.__applyFormat(defaultPropertyValue, formatter)
+        value = self.__properties.get(key, _MISSING)     # A single lookup, those of a _PropertyDict are slower than the ones of a dict.
+        if value is not _MISSING:
+            if _statistics is not None:
+                _statistics._recordLookup(key, 0)
+            return self.__applyFormat(value, formatter) if formatter else value
+        defaults = self.__defaults
+        if defaults is not None:    # Resolved through the flattened index of the defaults, regardless of the depth of the chain.
+            properties = defaults.__lookupIndex().get(key)
+            if properties is not None:
+                value = properties.get(key)
+                if value:
+                    if _statistics is not None:
+                        _statistics._recordLookup(key, self.__chainDepth(properties))
+                    return self.__applyFormat(value, formatter) if formatter else value
+        if _statistics is not None:
+            _statistics._recordLookup(key, None)
         return self.__applyFormat(defaultValue, formatter)
+
+    def __chainDepth(self, properties):
+        """
+        Returns the depth of the local property list :param properties in the defaults chain, 0 being the local property list of this properties.
+        """
+        depth = 0
+        chain = self
+        while chain is not None and chain.__properties is not properties:
+            chain = chain.__defaults
+            depth += 1
+        return depth
         
     def getExpandedProperty(self, key, defaultValue=None, formatter=None):
         """
         Does the same thing as :py:func:`getProperty` with the difference that if the value of the property contains a reference to another property
         using ${reference-key} then expand the reference key with its corresponding value in the local property list or default property list (recursive)
         before returning. If there is no referencing property then the method behaves exactly like py:func:`getProperty`.
+        Expanded values are cached per key, the cache is invalidated when the key, any key it references or the default properties change.
+        Raises :py:class:`CyclicReferenceError` if the references form a cycle.
         :param key: The property key to search.
         :param defaultValue: The default value to return if property key is not found. The default value for :param defaultValue is None.
         :param formatter: The formatter function to apply on the value before returning the result. By default there is no default formatter.
         """        
-        value = self.getProperty(key, defaultValue)
-        if value and re.match('.*\${([^}]+).*', value): 
-            for refKey in re.findall('\$\{([^\}]+)\}', value):  #same match can occur more than once.
-                refValue = self.getExpandedProperty(refKey)
-                if refValue:
-                    value = re.sub('\${' + refKey +'}', refValue, value)    #replaces all occurances, but its OKay.
+        self.__validateExpanded()
+        value = self.__expand(key, [])
+        if value is None and isinstance(defaultValue, basestring):
+            value = self.__expandValue(None, defaultValue, [])     # The default value is expanded too, but never cached.
         return self.__applyFormat(value, formatter)
-        
-    def list(self, out=sys.stdout):
+
+    def __getConverted(self, key, defaultValue, conversion, converter):
         """
-        Prints the property list out to the given stream or writer.
-        :param out: The stream/writer to print the properties. This must be a derived class from IOBase or a file type. Defaults to sys.stdout 
+        Returns the expanded value of :param key converted by :param converter, or :param defaultValue if the key is not found. The converted
+        value is cached per key and :param conversion, and invalidated along with the expanded value, i.e. when the key or any key it references
+        changes. A conversion error raises a ValueError on the first access, the error is cached as well and raised again on the next accesses
+        without converting again.
         """
-        if issubclass(out.__class__, IOBase) or issubclass(out.__class__, file) or issubclass(out.__class__, StringIO):
-            pprint.pprint(self.getAllProps(), out) # pretty print the properties
+        self.__validateExpanded()
+        converted = self.__converted.get(key)
+        result = converted.get(conversion, _MISSING) if converted is not None else _MISSING
+        if result is not _MISSING:
+            if _statistics is not None:
+                _statistics._recordConversion(key, conversion, True)
         else:
-            raise TypeError('Provided stream/writer is not a file or derived from :' + IOBase.__class__.__name__)
-    
+            if _statistics is not None:
+                _statistics._recordConversion(key, conversion, False)
+            value = self.getExpandedProperty(key)   # Through the subclasses, e.g. the published expansions of SharedProperties.
+            if value is None:
+                return defaultValue
+            try:
+                result = converter(value)
+            except (ValueError, TypeError, OverflowError), e:
+                result = ValueError('Unable to convert property %s=%s to %s: %s' % (key, value, conversion, e))
+            self.__converted.setdefault(key, {})[conversion] = result
+        if isinstance(result, ValueError):
+            raise result
+        return result
+
     @staticmethod
-    def __trailingBackSlashCount(s):
-        """
-        Counts the number of trailing backslashes (\) in the given string.
-        :param s: The input string.
-        """
-        backSlashCount=0
-        for c in s[::-1]:
-            if c=='\\':
-                backSlashCount += 1
-            else:
+    def __toBoolean(value):
+        try:
+            return _BOOLEANS[value.strip().lower()]
+        except KeyError:
+            raise ValueError('not one of ' + ', '.join(sorted(_BOOLEANS)))
+
+    @staticmethod
+    def __toDuration(value):
+        seconds = 0
+        end = 0
+        for match in _DURATION_PATTERN.finditer(value):
+            if match.start() != end:
                 break
-        return backSlashCount
-    
+            seconds += float(match.group(1)) * _DURATION_UNITS[(match.group(2) or 's').lower()]
+            end = match.end()
+        if end == 0 or value[end:].strip():
+            raise ValueError('not a duration, e.g. 1.5s, 250ms or 1h30m')
+        return seconds
+
     @staticmethod
-    def __getPropertyFromStringLine(s):
+    def __toSize(value):
+        match = _SIZE_PATTERN.match(value)
+        if not match:
+            raise ValueError('not a size, e.g. 512, 64KB or 1.5GiB')
+        return int(float(match.group(1)) * _SIZE_UNITS.get((match.group(2) or '').lower(), 1))
+
+    def getInt(self, key, defaultValue=None):
         """
-        Returns the (key, value) tuple after parsing the input string :param s. The method assumes that the given string conforms to the rules for property.
-        If the given string does not conforms to the property rules then throws a parse exception.
-        :param s: The string to parse the property. This string should conforms to the rules of property.
+        Returns the expanded value of the property key converted to an int, or :param defaultValue if the key is not found. Converted values are
+        cached, see :py:func:`__getConverted`. Raises ValueError if the value is not an int.
         """
-        precedingBackSlash = False
-        key = value = ''    # By default key and value are empty strings.
-        for i in range(len(s)):     # Loop through all characters in the property line.
-            if s[i] == '\\':    # Encountered escape character.
-                precedingBackSlash = not precedingBackSlash     # Invert precedingBackSlash as \\= needs to be parsed as \\ and = and not \ and \=.            
-            elif s[i] in '=:' and not precedingBackSlash:   # Property separator encountered.
-                key = s[:i]     # Key is everything before separator.
-                value = s[i+1:] # Value is everything after separator.
-                break;
-            else:
-                precedingBackSlash = False
-        if key == '':   # If no key has been parsed yet, then the property does not conforms with the rules. 
-            raise ParseError('Unable to parse property. Should conform to the property line rule.')
-        return (key.strip(), value.strip())
-    
-    def load(self, inStream=sys.stdin):
+        return self.__getConverted(key, defaultValue, 'int', int)
+
+    def getFloat(self, key, defaultValue=None):
         """
-        Reads a property list (key/value) from input stream.
-        :param inStream: input stream to read the property list. Defaults to sys.stdin
+        Returns the expanded value of the property key converted to a float, or :param defaultValue if the key is not found. Raises ValueError if
+        the value is not a float.
         """
-        accLine = []    # Line accumulator for multiline properties.    
-        for lines in inStream:
-            for line in lines.split('\r'):  # inStream does not break on '\r', so we have to do it ourselves.
-                if line.startswith('#') or line.startswith('!') or line.isspace():     # Ignore comments (#,!) and line comprising of whitespaces only.
-                    continue
-                line = line.strip()                        
-                if Properties.__trailingBackSlashCount(line) % 2 == 0:  # No trailing \ or even number of trailing \, we have read one complete property.
-                    accLine.append(line)
-                    propertyEntry = ''.join(accLine)    # Creating a complete property line with key and value.
-                    prop = Properties.__getPropertyFromStringLine(propertyEntry)    # Parse property line and get (key, value) as result or exception is thrown.
-                    self.properties[prop[0]] = prop[1]
-                    accLine=[]  # Reset the accumulator.
-                else:
-                    accLine.append(line[:-1].strip())   # Strip down white spaces before line break escape \\n            
-        if accLine != []:
-            raise ParseError('Invalid termination of stream, was expecting more.')                    
-    
-    @staticmethod
-    def __mergeSingleProperties(properties):
+        return self.__getConverted(key, defaultValue, 'float', float)
+
+    def getBoolean(self, key, defaultValue=None):
         """
-        Merge the :param properties and its default properties into a properties instance with an empty default properties, all the default properties are
-        merged into the top level properties dictionary. In case of duplicate properties in the defaults chain, precedence is given to the property found
-        at the topmost level.
+        Returns the expanded value of the property key converted to a bool, or :param defaultValue if the key is not found. true, yes, on and 1
+        are True, false, no, off and 0 are False, regardless of the case. Raises ValueError for any other value.
         """
-        if properties.defaults: # Has some defaults, recursively merge defaults. 
-            mergedProperties = Properties.__mergeSingleProperties(properties.defaults)
-            mergedProperties.properties.update(properties.properties) # merging the defaults property dictionary with the current top level dictionary.                        
-            return mergedProperties
-        else:   # No defaults, return a copy of the properties with default=None.
-            prop = Properties()
-            prop.properties = dict(properties.properties)
-            return prop
-        
-    @staticmethod
-    def mergeProperties(propertiesList=[]):
+        return self.__getConverted(key, defaultValue, 'bool', Properties.__toBoolean)
+
+    def getList(self, key, defaultValue=None, separator=','):
         """
-        Merge list of properties :param properties and their recursive default properties into a single properties instance, giving high precedence to the properties in the
-        end of the :param properties list. The returned list will have an empty default properties. 
-        In case of merging a single properties, it will merge the default properties (from bottom up) and the local properties itself will be 
-        merged last with the aggregated merge. See :func __mergeSingleProperties.
+        Returns the expanded value of the property key split on :param separator into a list of stripped strings, or :param defaultValue if the
+        key is not found. An empty value is an empty list. The items are cached as a tuple, every call returns a new list which the caller may
+        modify.
         """
-        mergedProperties = Properties()
-        for properties in propertiesList:
-            mergedProperties.properties.update(Properties.__mergeSingleProperties(properties).properties)
-        return mergedProperties
-    
-    @staticmethod
-    def createPropertiesFromPropertiesFile(fName, defaultProperties=None):                
-        propFile = open(fName, 'r')                                    
-        prop = Properties()
-        prop.load(propFile)
-        return prop
-            
-    def loadFromXML(self, inStream=sys.stdin):
+        items = self.__getConverted(key, None, 'list' + separator,
+                                    lambda value: tuple(item.strip() for item in value.split(separator)) if value.strip() else ())
+        return list(items) if items is not None else defaultValue
+
+    def getDuration(self, key, defaultValue=None):
         """
-        Loads all the properties in the XML document on the given input stream.
-        :param inStream: input stream to read the property list in the XML document. Defaults to sys.stdin
+        Returns the expanded value of the property key converted to a duration in seconds (float), or :param defaultValue if the key is not found.
+        The value is a number with an optional unit, ms, s, m, h, d or w, or a sequence of these e.g. 1h30m. Numbers without a unit are seconds.
+        Raises ValueError if the value is not a duration.
         """
-        raise NotImplementedError ('Not implemented yet.')
-    
-    def setProperty(self, key, value):
+        return self.__getConverted(key, defaultValue, 'duration', Properties.__toDuration)
+
+    def getSize(self, key, defaultValue=None):
         """
-        Puts the key/value pair in the properties list, uses the dictionary d[key]=value. Enforces the use of String for key and value.
+        Returns the expanded value of the property key converted to a size in bytes (int), or :param defaultValue if the key is not found. The
+        value is a number with an optional unit, B, K, M, G, T or P, optionally followed by iB or B e.g. 64KB, 1.5GiB. Units are powers of 1024.
+        Raises ValueError if the value is not a size.
         """
-        if not key or not value or not issubclass(key.__class__, str) or not issubclass(value.__class__, str):
-            raise TypeError('Key and value for the properties must be string.')
-        self.properties[key] = value
-    
-    def store(self, out=sys.stdout):
+        return self.__getConverted(key, defaultValue, 'size', Properties.__toSize)
+
+    def __defaultsStamp(self):
         """
-        Writes the properties according to the properties file format on the give store stream. Properties are written in the key sorted order, and in a
-        format that is suitable for :func load. Properties from the defaul properties will not be written by this method.
-        :param out: The stream/writer to store the properties. This must be a file or derived class from IOBase or StringIO. Defaults to sys.stdout 
+        Returns a stamp identifying the current state of the defaults chain, the stamp changes whenever a default properties in the chain is
+        replaced or mutated.
         """
-        if (issubclass(out.__class__, IOBase) and out.writable()) or issubclass(out.__class__, StringIO) or issubclass(out.__class__, file):            
-            for k in sorted(self.properties.iterkeys()):
-                out.write (unicode(k + '=' + self.properties[k] + '\n'))            
-        else:
-            raise TypeError('Provided stream/writer is not derived from IOBase or not is StringIO or not a writable file.')
-            
\ No newline at end of file
+        stamp = []
+        defaults = self.__defaults
+        while defaults is not None:
+            stamp.append((defaults,) + defaults.__layerStamp())
+            defaults = defaults.__defaults
+        return tuple(stamp)
+
+    def _allocateCaches(self):
+        """
+        Allocates the expansion caches if they are not yet, e.g. before the properties is published to reader threads, see
+        :py:class:`ConcurrentProperties`. The expanded cache is assigned last, the other caches are allocated once it is.
+        """
+        if self.__expanded is None:
+            self.__templates = {}
+            self.__dependents = {}
+            self.__converted = {}
+            self.__expanded = {}
+
+    def __validateExpanded(self):
+        """
+        Drops the whole expanded cache if the defaults chain has changed since the cache was filled. Changes to the local properties are
+        invalidated key by key, see :py:func:`__invalidate`. The caches are allocated on the first call. The dropped caches are replaced by new
+        dictionaries rather than cleared, so that the readers of a shared snapshot still using them are not affected.
+        """
+        if self.__expanded is None:
+            self._allocateCaches()
+        clock = _mutationCount
+        if self.__expandedClock != clock:
+            stamp = self.__viewStamp() + self.__defaultsStamp()
+            if stamp != self.__expandedStamp:
+                self.__dependents = {}
+                self.__converted = {}
+                self.__expanded = {}
+                self.__expandedStamp = stamp
+            self.__expandedClock = clock
+
+    def __currentExpandedStamp(self):
+        """
+        Returns True if the expanded cache is allocated and up to date with the local property list and the defaults chain.
+        """
+        return self.__expanded is not None and self.__expandedStamp == self.__viewStamp() + self.__defaultsStamp()
+
+    def __invalidate(self, key):
+        """
+        Removes the cached expansion of :param key and, transitively, of every key whose expansion referenced it.
+        """
+        if self.__expanded is None:     # Nothing expanded yet.
+            return
+        pending = [key]
+        while pending:
+            k = pending.pop()
+            self.__expanded.pop(k, None)
+            self.__converted.pop(k, None)
+            pending.extend(self.__dependents.pop(k, ()))
+
+    def __compile(self, key, value):
+        """
+        Returns the template segments of :param value, i.e. the literal parts at even and the reference keys at odd positions. The
+        segments are compiled once per value and kept as long as the value of :param key does not change.
+        """
+        template = self.__templates.get(key)
+        if template is None or template[0] is not value:
+            template = (value, tuple(_REFERENCE_PATTERN.split(value)))
+            self.__templates[key] = template
+        return template[1]
+
+    def __expand(self, key, resolving):
+        """
+        Returns the expanded value of :param key, from the cache if possible. Returns None if the key is not found.
+        :param resolving: The keys currently being expanded, used to detect reference cycles.
+        """
+        value = self.__expanded.get(key, _MISSING)     # A single lookup, the cache may be replaced meanwhile by another reader.
+        if value is not _MISSING:
+            if _statistics is not None:
+                _statistics._recordExpansion(key, len(resolving), True)
+            return value
+        if _statistics is not None:
+            _statistics._recordExpansion(key, len(resolving), False)
+        value = self.getProperty(key)
+        if value and '${' in value:
+            if key in resolving:
+                raise CyclicReferenceError(resolving[resolving.index(key):] + [key])
+            resolving.append(key)
+            value = self.__expandValue(key, value, resolving)
+            resolving.pop()
+        self.__expanded[key] = value
+        return value
+
+    def __expandValue(self, key, value, resolving):
+        """
+        Replaces the references in :param value with their expanded values, references that can not be resolved are left as they are.
+        :param key: The key the value belongs to, its expansion is registered as a dependent of the referenced keys. None for values that
+        are not cached.
+        """
+        segments = self.__compile(key, value) if key is not None else _REFERENCE_PATTERN.split(value)
+        if len(segments) == 1:
+            return value
+        parts = list(segments)
+        for i in range(1, len(segments), 2):
+            refKey = segments[i]
+            if key is not None:
+                self.__dependents.setdefault(refKey, set()).add(key)
+            refValue = self.__expand(refKey, resolving)
+            parts[i] = refValue if refValue else '${' + refKey + '}'
+        return ''.join(parts)
+
+    def expandAll(self, asProperties=False, strict=False):
+        """
+        Expands every property of this properties and its default properties in a single pass and returns the expanded key/values. The references
+        of all the keys are collected into one dependency graph, which is resolved in topological order so that each value is expanded exactly once.
+        The expanded values are also cached, see :py:func:`getExpandedProperty`. References to keys that do not exist are left as they are, as
+        :py:func:`getExpandedProperty` does.
+        Raises :py:class:`UnresolvedReferenceError` reporting all the reference cycles, and the dangling references if :param strict is True,
+        at once. The values that could be expanded are cached anyway.
+        :param asProperties: If True then return the expanded values as a properties with an empty default properties, otherwise as a dictionary.
+        :param strict: If True then references to keys that do not exist are reported as errors.
+        """
+        self.__validateExpanded()
+        index = self.__lookupIndex()
+        ownProperties = self.__properties
+        values = {}     # The values getProperty returns, keys with an empty value in the defaults are not resolved by references.
+        references = {}     # key -> referenced keys, for the values with references.
+        for key, properties in index.iteritems():
+            value = properties[key]
+            values[key] = value
+            if value and '${' in value:
+                references[key] = self.__compile(key, value)[1::2]
+            elif not value and properties is not ownProperties:
+                values[key] = None
+        expanded = {}
+        cycles = []
+        dangling = []
+        failed = set()  # Keys in or depending on a cycle.
+        state = {}      # key -> True while its references are being expanded, False once expanded.
+        for root in references:
+            if root in state:
+                continue
+            state[root] = True
+            path = [root]
+            stack = [iter(references[root])]
+            while stack:
+                key = path[-1]
+                for refKey in stack[-1]:
+                    if refKey in references:
+                        refState = state.get(refKey)
+                        if refState is None:    # Expand the referenced key first.
+                            state[refKey] = True
+                            path.append(refKey)
+                            stack.append(iter(references[refKey]))
+                            break
+                        elif refState:  # Referenced key is on the path, found a cycle.
+                            cycle = path[path.index(refKey):] + [refKey]
+                            if cycle not in cycles:     # The same reference may occur more than once in a value.
+                                cycles.append(cycle)
+                            failed.add(key)
+                    elif refKey not in values:
+                        dangling.append((key, refKey))
+                else:   # All the referenced keys are done.
+                    path.pop()
+                    stack.pop()
+                    state[key] = False
+                    refKeys = references[key]
+                    if key in failed or any(refKey in failed for refKey in refKeys):
+                        failed.add(key)
+                        continue
+                    parts = list(self.__compile(key, values[key]))
+                    for i, refKey in enumerate(refKeys):
+                        refValue = expanded[refKey] if refKey in expanded else values.get(refKey)
+                        parts[2 * i + 1] = refValue if refValue else '${' + refKey + '}'
+                    expanded[key] = ''.join(parts)
+        dependents = {}
+        for key in expanded:
+            for refKey in references[key]:
+                dependents.setdefault(refKey, []).append(key)
+        self.__primeExpanded(expanded, dependents)
+        if cycles or (strict and dangling):
+            raise UnresolvedReferenceError(cycles, sorted(set(dangling)) if strict else [])
+        for key, value in expanded.iteritems():
+            values[key] = value
+        for key, properties in index.iteritems():   # Keys with an empty value in the defaults are kept empty.
+            if values[key] is None:
+                values[key] = properties[key]
+        if asProperties:
+            prop = Properties()
+            prop.properties = values
+            return prop
+        return values
+
+    def __putProperties(self, entries):
+        """
+        Stores the (key, value) pairs of :param entries in the local property list, invalidates the expansions depending on the keys and keeps the
+        lookup index up to date. The keys of the small batches, e.g. of :py:func:`setProperty`, are logged so that the lookup indexes of the
+        properties having this one in their defaults chain are updated key by key, see :py:func:`__patchIndex`.
+        """
+        logged = entries.__class__ is tuple and len(entries) <= _INDEX_PATCH_LIMIT
+        before = self.__layerStamp()
+        completed = False
+        indexed = self.__indexClock == _mutationCount and self.__index.__class__ is dict    # The index is up to date and can be updated in place.
+        index = self.__index
+        sortedKeys = self.__sortedKeys if indexed and self.__sortedKeysIndex is index else None
+        inserted = 0    # Number of new keys inserted in the sorted keys.
+        properties = self.__properties
+        current = self.__currentExpandedStamp()     # The expansions are invalidated key by key rather than all dropped, see __validateExpanded.
+        try:
+            if indexed or self.__expanded:
+                for key, value in entries:
+                    properties[key] = value
+                    self.__invalidate(key)
+                    if indexed:
+                        if sortedKeys is not None and key not in index:
+                            if inserted < _SORTED_INSERT_LIMIT:
+                                bisect.insort(sortedKeys, key)
+                                inserted += 1
+                            else:   # Bulk load, every insertion would move the keys after it.
+                                sortedKeys = self.__sortedKeys = self.__sortedKeysIndex = None
+                        index[key] = properties
+            else:   # Nothing to keep up to date key by key.
+                properties.update(entries)
+            completed = True
+        finally:
+            self.__touch()
+            if logged and completed:
+                self.__logChange(before, tuple(key for key, _ in entries))
+            else:
+                self.__changes = None
+            if indexed:
+                self.__indexStamp = self.__chainStamp()
+                self.__indexClock = _mutationCount
+            if current:
+                self.__expandedStamp = self.__viewStamp() + self.__defaultsStamp()
+
+    def __removeProperties(self, keys):
+        """
+        Removes the :param keys from the local property list and invalidates the expansions depending on them.
+        """
+        properties = self.__properties
+        current = self.__currentExpandedStamp()
+        try:
+            for key in keys:
+                del properties[key]
+                self.__invalidate(key)
+        finally:
+            self.__touch()  # The lookup index is rebuilt, the removed keys may now be resolved by the default properties.
+            if current:
+                self.__expandedStamp = self.__viewStamp() + self.__defaultsStamp()
+
+    def __putProperty(self, key, value):
+        """
+        Stores the key/value pair in the local property list, see :py:func:`__putProperties`.
+        """
+        self.__putProperties(((key, value),))
+        
+    def list(self, out=sys.stdout):
+        """
+        Prints the property list out to the given stream or writer.
+        :param out: The stream/writer to print the properties. This must be a derived class from IOBase or a file type. Defaults to sys.stdout 
+        """
+        from io import IOBase
+        if issubclass(out.__class__, IOBase) or issubclass(out.__class__, file) or issubclass(out.__class__, StringIO):
+            import pprint
+            pprint.pprint(self.getAllProps(), out) # pretty print the properties
+        else:
+            raise TypeError('Provided stream/writer is not a file or derived from :' + IOBase.__class__.__name__)
+    
+    @staticmethod
+    def iterParse(inStream=sys.stdin, unescape=False):
+        """
+        Parses the property list on the input stream and yields a (key, value, lineNumber) tuple for each property as soon as it is read, without
+        collecting the properties. Memory use is independent of the size of the stream, which is read in large blocks. The line number is the
+        line the property starts at, counting from 1. Streams without a read method are iterated over instead, each item being one or more
+        complete lines. :py:func:`load` is built on top of this method, see :py:class:`PropertiesParser` to parse input that is not a stream.
+        :param inStream: input stream to read the property list. Defaults to sys.stdin
+        :param unescape: If True then the escape sequences in the keys and values are replaced, see :py:func:`load`.
+        """
+        parser = PropertiesParser(unescape)
+        start = time.time() if _statistics is not None else None
+        if hasattr(inStream, 'read'):
+            block = inStream.read(_BLOCK_SIZE)
+            while block:
+                for entry in parser.feed(block):
+                    yield entry
+                block = inStream.read(_BLOCK_SIZE)
+        else:
+            for item in inStream:
+                for entry in parser.feedLines(item):
+                    yield entry
+        for entry in parser.close():
+            yield entry
+        if start is not None and _statistics is not None:   # The time spent by the consumer of the properties is included.
+            _statistics._recordParse(getattr(inStream, 'name', None), parser.lineNumber, time.time() - start)
+
+    def load(self, inStream=sys.stdin, unescape=False):
+        """
+        Reads a property list (key/value) from input stream, see :py:func:`iterParse`.
+        :param inStream: input stream to read the property list. Defaults to sys.stdin
+        :param unescape: If True then the escape sequences in the keys and values (\\t, \\n, \\r, \\f, \\uXXXX, \\=, \\: etc.) are replaced by the
+        characters they stand for, as java.util.Properties does. By default the keys and values are kept as they are written.
+        """
+        self.loadEntries(Properties.iterParse(inStream, unescape))
+
+    def loadEntries(self, entries):
+        """
+        Stores the (key, value, lineNumber) tuples of :param entries, as returned by :py:class:`PropertiesParser` and :py:func:`iterParse`, in
+        the local property list, keeping the caches up to date as :py:func:`load` does. Unlike :py:func:`setProperty`, the values may be empty
+        or unicode, as parsed.
+        """
+        self.__putProperties((key, value) for key, value, _ in entries)
+    
+    @staticmethod
+    def mergeProperties(propertiesList=[]):
+        """
+        Merge list of properties :param properties and their recursive default properties into a single properties instance, giving high precedence to the properties in the
+        end of the :param properties list. The returned list will have an empty default properties.
+        In case of merging a single properties, it will merge the default properties (from bottom up) and the local properties itself will be
+        merged last with the aggregated merge. Every value is copied once, see :py:func:`MergedProperties.materialize`, use a
+        :py:class:`MergedProperties` view to merge without copying anything.
+        """
+        return MergedProperties(propertiesList).materialize()
+
+    @staticmethod
+    def createPropertiesFromPropertiesFile(fName, defaultProperties=None, snapshotFile=None):
+        """
+        Creates a properties and loads the property list in the file :param fName.
+        :param fName: The property file to load.
+        :param defaultProperties: The property list that is to be used as the default property list, by default there are no default properties.
+        :param snapshotFile: Optional snapshot file, see :py:func:`storeSnapshot`. If the snapshot is fresh, i.e. :param fName has not been
+        modified since the snapshot was stored, the properties are loaded from the snapshot instead of being parsed, otherwise the file is
+        parsed and the snapshot is (re)written. The pre-expanded values are only used if there are no default properties.
+        """
+        if snapshotFile is not None:
+            snapshot = Properties.__readSnapshot(snapshotFile, [fName])
+            if snapshot is not None:
+                prop = Properties(defaultProperties)
+                prop.properties = snapshot['layers'][-1]
+                if defaultProperties is None and len(snapshot['layers']) == 1:
+                    prop.__primeExpanded(snapshot['expanded'], snapshot['dependents'])
+                prop.__source = fName
+                return prop
+        propFile = open(fName, 'r')
+        try:
+            prop = Properties(defaultProperties)
+            prop.load(propFile)
+        finally:
+            propFile.close()
+        prop.__source = fName
+        if snapshotFile is not None:
+            prop.storeSnapshot(snapshotFile, [fName], includeDefaults=defaultProperties is None)
+        return prop
+
+    @staticmethod
+    def mergePropertiesFiles(fNames, processes=None, useThreads=False):
+        """
+        Loads the property files :param fNames concurrently and merges them into a single properties instance with an empty default properties.
+        The precedence is the same as for :py:func:`mergeProperties`, properties in files at the end of the list override the ones before.
+        :param fNames: The property files to load, in precedence order.
+        :param processes: The number of worker processes (or threads), defaults to the number of CPUs. The worker processes parse in parallel,
+        but every parsed property list is pickled back to this process, which costs a good part of parsing it, so that a pool only pays off
+        with several CPUs. The files are loaded in this process, without any pool, when a single worker would run, e.g. on a single CPU.
+        :param useThreads: If True then the files are parsed in a thread pool instead of a process pool, which avoids copying the parsed
+        properties between processes but does not parse in parallel because of the GIL.
+        """
+        fNames = list(fNames)
+        if processes is None and len(fNames) > 1:
+            import multiprocessing
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        processes = min(processes or 1, len(fNames))
+        if processes <= 1:
+            propertiesList = [_loadPropertiesFile(fName) for fName in fNames]
+        else:
+            import multiprocessing.pool
+            pool = (multiprocessing.pool.ThreadPool if useThreads else multiprocessing.Pool)(processes)
+            try:
+                propertiesList = pool.map(_loadPropertiesFile, fNames)
+            finally:
+                pool.close()
+                pool.join()
+        mergedProperties = Properties()
+        for properties in propertiesList:
+            mergedProperties.properties.update(properties)
+        return mergedProperties
+
+    @staticmethod
+    def __fingerprint(sources):
+        """
+        Returns the (path, modification time, size, CRC-32 of the content) fingerprints of the :param sources files, used to tell whether a
+        snapshot is fresh. The modification time and size alone do not tell a file rewritten with the same size within the same second, or
+        whose modification time was restored, e.g. by cp -p, tar or rsync -t. Checksumming the content costs a read of the files, much less
+        than parsing them.
+        """
+        fingerprints = []
+        for source in sources:
+            crc = 0
+            with open(source, 'rb') as sourceFile:
+                stat = os.fstat(sourceFile.fileno())
+                for block in iter(lambda: sourceFile.read(_BLOCK_SIZE), ''):
+                    crc = zlib.crc32(block, crc)
+            fingerprints.append((os.path.abspath(source), stat.st_mtime, stat.st_size, crc & 0xffffffff))
+        return fingerprints
+
+    @staticmethod
+    def __writeAtomically(fName, write, mode='wb'):
+        """
+        Writes the file :param fName through a temporary file which is renamed to :param fName once complete, so that readers never see a partially
+        written file. The temporary file is unique, concurrent writers of the same file do not interfere, and gets the permissions of the file
+        it replaces. A new file is readable and writable by its owner only.
+        :param write: Function called with the temporary file to write the content.
+        :param mode: The mode the temporary file is opened with.
+        """
+        import tempfile
+        fd, tmpName = tempfile.mkstemp('.tmp', os.path.basename(fName) + '.', os.path.dirname(os.path.abspath(fName)))
+        try:
+            with os.fdopen(fd, mode) as tmpFile:
+                write(tmpFile)
+                tmpFile.flush()
+                os.fsync(tmpFile.fileno())
+            if os.path.exists(fName):
+                os.chmod(tmpName, os.stat(fName).st_mode & 07777)
+            os.rename(tmpName, fName)
+        except:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
+    def storeSnapshot(self, fName, sources=(), includeDefaults=True):
+        """
+        Compiles the properties into a compact binary snapshot file which :py:func:`loadSnapshot` loads without parsing anything. The snapshot
+        holds the local property lists of the defaults chain and the expanded value of every key, and is keyed by the paths, modification times,
+        sizes and content checksums of the :param sources files, so that it is considered stale as soon as one of them changes.
+        :param fName: The snapshot file to write, it is written atomically.
+        :param sources: The files the properties were loaded from.
+        :param includeDefaults: If False then only the local property list is stored, without the default properties and the expanded values.
+        """
+        layers = []
+        chain = self
+        while chain is not None:
+            layers.insert(0, dict(chain.properties))
+            chain = chain.__defaults if includeDefaults else None
+        expanded = dependents = {}
+        if includeDefaults:
+            try:
+                self.expandAll()
+            except UnresolvedReferenceError:    # The keys in cycles are left out, expanding them raises again after loading the snapshot.
+                pass
+            expanded = self.__expanded
+            dependents = dict((key, list(keys)) for key, keys in self.__dependents.iteritems())
+        snapshot = {'format': _SNAPSHOT_FORMAT, 'sources': Properties.__fingerprint(sources), 'layers': layers,
+                    'expanded': expanded, 'dependents': dependents}
+        Properties.__writeAtomically(fName, lambda snapshotFile: marshal.dump(snapshot, snapshotFile, 2))
+
+    @staticmethod
+    def __readSnapshot(fName, sources=None):
+        """
+        Returns the snapshot stored in the file :param fName, or None if the file does not exist, is not a snapshot or is stale.
+        :param sources: If given, the snapshot must have been stored for exactly these source files.
+        """
+        try:
+            with open(fName, 'rb') as snapshotFile:
+                snapshot = marshal.loads(snapshotFile.read())
+            if not isinstance(snapshot, dict) or snapshot.get('format') != _SNAPSHOT_FORMAT:
+                return None
+            recorded = [tuple(fingerprint) for fingerprint in snapshot['sources']]
+            if sources is not None and [fingerprint[0] for fingerprint in recorded] != [os.path.abspath(source) for source in sources]:
+                return None
+            if recorded != Properties.__fingerprint([fingerprint[0] for fingerprint in recorded]):
+                return None
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            return None
+        return snapshot
+
+    @staticmethod
+    def loadSnapshot(fName, sources=None):
+        """
+        Returns the properties, with their defaults chain, stored in the snapshot file :param fName by :py:func:`storeSnapshot`. Returns None if
+        the snapshot does not exist or is stale, i.e. one of the files it was stored for has changed since.
+        :param fName: The snapshot file.
+        :param sources: If given, the snapshot must have been stored for exactly these source files.
+        """
+        snapshot = Properties.__readSnapshot(fName, sources)
+        if snapshot is None:
+            return None
+        prop = None
+        for layer in snapshot['layers']:
+            prop = Properties(prop)
+            prop.properties = layer
+        prop.__primeExpanded(snapshot['expanded'], snapshot['dependents'])
+        return prop
+
+    def __primeExpanded(self, expanded, dependents):
+        """
+        Fills the expanded cache with the values expanded beforehand, e.g. stored in a snapshot.
+        """
+        self.__validateExpanded()
+        self.__expanded.update(expanded)
+        for key, keys in dependents.iteritems():
+            self.__dependents.setdefault(key, set()).update(keys)
+            
+    def addListener(self, listener):
+        """
+        Registers :param listener to be notified of the changes made by :py:func:`reload`. The listener is called as listener(properties, diff)
+        where diff is a :py:class:`PropertiesDiff`, and only if something has changed.
+        """
+        self.__listeners += (listener,)
+
+    def removeListener(self, listener):
+        """
+        Unregisters a listener registered by :py:func:`addListener`.
+        """
+        listeners = list(self.__listeners)
+        listeners.remove(listener)
+        self.__listeners = tuple(listeners)
+
+    def reload(self, inStream=None, unescape=False):
+        """
+        Re-reads the property list and applies only the differences to the local property list: added and changed keys are stored and keys that
+        are no longer in the property list are removed. Only the cached expansions that (transitively) reference a changed key are invalidated.
+        The registered listeners are notified of the changes, see :py:func:`addListener`. Nothing is changed if the property list can not be parsed.
+        Returns the :py:class:`PropertiesDiff`.
+        :param inStream: input stream to read the property list. Defaults to the file the properties were created from by
+        :py:func:`createPropertiesFromPropertiesFile`.
+        :param unescape: If True then the escape sequences in the keys and values are replaced, see :py:func:`load`.
+        """
+        if inStream is None:
+            if self.__source is None:
+                raise ValueError('No input stream given and the properties were not created from a file.')
+            with open(self.__source, 'r') as propFile:
+                return self.reload(propFile, unescape)
+        loaded = dict((key, value) for key, value, _ in Properties.iterParse(inStream, unescape))
+        properties = self.__properties
+        added = frozenset(key for key in loaded if key not in properties)
+        changed = frozenset(key for key in loaded if key in properties and properties[key] != loaded[key])
+        removed = frozenset(key for key in properties if key not in loaded)
+        diff = PropertiesDiff(added, changed, removed)
+        if added or changed or removed:
+            self.__putProperties(tuple((key, loaded[key]) for key in added | changed))
+            if removed:
+                self.__removeProperties(removed)
+            for listener in self.__listeners:
+                listener(self, diff)
+        return diff
+
+    @staticmethod
+    def __iterParseXML(inStream):
+        """
+        Yields the (key, value) tuples of the entries in the XML document on :param inStream, which must conform to the java.util.Properties DTD.
+        The document is parsed incrementally and every element is discarded once handled, so memory use is independent of the document size.
+        """
+        from xml.etree import cElementTree
+        try:
+            root = None
+            for event, element in cElementTree.iterparse(inStream, ('start', 'end')):
+                if root is None:
+                    if element.tag != 'properties':
+                        raise ParseError('Unable to parse XML properties, the root element must be properties.')
+                    root = element
+                elif event == 'start':
+                    if element.tag not in ('entry', 'comment'):
+                        raise ParseError('Unable to parse XML properties, unexpected element %s.' % element.tag)
+                elif element is not root:
+                    if element.tag == 'entry':
+                        key = element.get('key')
+                        if key is None:
+                            raise ParseError('Unable to parse XML properties, entry without key.')
+                        yield (_intern(key), element.text or '')
+                    root.clear()    # Discard the handled elements.
+        except ParseError:
+            raise
+        except SyntaxError, e:     # Malformed document, cElementTree.ParseError.
+            raise ParseError('Unable to parse XML properties: %s' % e)
+
+    def loadFromXML(self, inStream=sys.stdin):
+        """
+        Loads all the properties in the XML document on the given input stream. The document must conform to the java.util.Properties DTD:
+        a properties root element with an optional comment element followed by entry elements, each with a key attribute and the value as text.
+        The document is parsed incrementally, memory use does not depend on its size.
+        :param inStream: input stream to read the property list in the XML document. Defaults to sys.stdin
+        """
+        self.__putProperties(Properties.__iterParseXML(inStream))
+
+    @staticmethod
+    def __isWritable(out):
+        """
+        Returns True if :param out is a writable file, or derived from IOBase or StringIO.
+        """
+        from io import IOBase
+        if issubclass(out.__class__, file):
+            return any(mode in out.mode for mode in 'wa+')
+        return (issubclass(out.__class__, IOBase) and out.writable()) or issubclass(out.__class__, StringIO)
+
+    @staticmethod
+    def __writeText(out, text, encoding):
+        """
+        Writes the unicode :param text on :param out, encoded with :param encoding unless :param out is a text stream.
+        """
+        from io import TextIOBase
+        out.write(text if isinstance(out, TextIOBase) else text.encode(encoding))
+
+    def storeToXML(self, out=sys.stdout, comment=None, encoding='UTF-8'):
+        """
+        Writes the properties as an XML document conforming to the java.util.Properties DTD, suitable for :py:func:`loadFromXML`. Properties are
+        written in the key sorted order and in large chunks. Properties from the default properties will not be written by this method.
+        The str keys and values are taken as UTF-8 encoded text, as they are when loaded from a UTF-8 property file, and raise
+        UnicodeDecodeError if they are not valid UTF-8.
+        :param out: The stream/writer to store the properties. This must be a file or derived class from IOBase or StringIO. Defaults to sys.stdout
+        :param comment: Optional comment written in the comment element of the document.
+        :param encoding: The encoding of the document.
+        """
+        if not Properties.__isWritable(out):
+            raise TypeError('Provided stream/writer is not derived from IOBase or not is StringIO or not a writable file.')
+        from xml.sax.saxutils import escape, quoteattr
+        chunk = [_XML_HEADER % encoding, '<properties>\n']
+        if comment is not None:
+            chunk.append('<comment>%s</comment>\n' % escape(_decodeText(comment)))
+        properties = self.properties
+        for key in sorted(properties):
+            chunk.append('<entry key=%s>%s</entry>\n' % (quoteattr(_decodeText(key)), escape(_decodeText(properties[key]))))
+            if len(chunk) >= 1024:
+                Properties.__writeText(out, u''.join(chunk), encoding)
+                chunk = []
+        chunk.append('</properties>\n')
+        Properties.__writeText(out, u''.join(chunk), encoding)
+    
+    @staticmethod
+    def enableStatistics(statistics=None):
+        """
+        Starts collecting the statistics of all the properties in :param statistics, or in a new :py:class:`PropertiesStatistics`, and returns
+        it. While disabled, the default, the statistics cost a single check per operation.
+        """
+        global _statistics
+        _statistics = statistics if statistics is not None else PropertiesStatistics()
+        return _statistics
+
+    @staticmethod
+    def disableStatistics():
+        """
+        Stops collecting the statistics, returns the :py:class:`PropertiesStatistics` collected so far or None if they were not enabled.
+        """
+        global _statistics
+        statistics, _statistics = _statistics, None
+        return statistics
+
+    @staticmethod
+    def getStatistics():
+        """
+        Returns the :py:class:`PropertiesStatistics` being collected, None if they are not enabled.
+        """
+        return _statistics
+
+    def publish(self, fName, expanded=False):
+        """
+        Publishes the properties, merged with their default properties as :py:func:`mergeProperties` does, in the file :param fName in a compact
+        indexed layout that :py:class:`SharedProperties` maps read-only. Any number of processes can attach to the file without parsing it,
+        and share its pages: put the file on a memory file system, e.g. /dev/shm on Linux, to keep it in shared memory. The file is replaced
+        atomically, the processes attached to the previous file keep reading it until they attach again.
+        :param fName: The file to publish the properties in.
+        :param expanded: If True then the expanded values are published too, see :py:func:`expandAll`, so that the attached processes do
+        not expand anything. The keys in reference cycles are not expanded, expanding them raises in the attached processes.
+        """
+        values = self.getAllProps()
+        expandedValues = {}
+        if expanded:
+            try:
+                self.expandAll()
+            except UnresolvedReferenceError:
+                pass
+            expandedValues = dict((key, value) for key, value in self.__expanded.iteritems()
+                                  if key in values and value is not None and value != values[key])
+        Properties.__writeAtomically(fName, lambda sharedFile: sharedFile.write(_packShared(values, expandedValues)))
+
+    def copy(self):
+        """
+        Returns a copy of the properties, with the same default properties and a copy of the local property list. The caches and the listeners
+        are not copied.
+        """
+        prop = Properties(self.__defaults)
+        prop.properties = _PropertyDict(self.__properties)
+        prop.__source = self.__source
+        return prop
+
+    def setProperty(self, key, value):
+        """
+        Puts the key/value pair in the properties list, uses the dictionary d[key]=value. Enforces the use of String for key and value.
+        """
+        if not key or not value or not issubclass(key.__class__, str) or not issubclass(value.__class__, str):
+            raise TypeError('Key and value for the properties must be string.')
+        self.__putProperty(_intern(key), value)
+    
+    @staticmethod
+    def __escape(s):
+        """
+        Returns :param s with the characters that have a special meaning in the properties file format escaped, so that :py:func:`load` with
+        unescape=True reads it back unchanged. Non printable characters, the non ASCII characters of a unicode, and leading and trailing spaces
+        which :py:func:`load` strips, are written as \\uXXXX. The non ASCII bytes of a str, UTF-8 encoded text, are kept as they are, since
+        \\uXXXX stands for a character and is read back as unicode. The result is a str.
+        """
+        if s.__class__ is str:
+            return _STORE_ESCAPE_BYTES_PATTERN.sub(Properties.__escapeMatch, s)
+        return str(_STORE_ESCAPE_PATTERN.sub(Properties.__escapeMatch, s))
+
+    @staticmethod
+    def __escapeMatch(match):
+        c = match.group()
+        return _STORE_ESCAPES.get(c) or '\\u%04x' % ord(c)
+
+    def store(self, out=sys.stdout, sort=True, includeDefaults=False, escape=False):
+        """
+        Writes the properties according to the properties file format on the give store stream, in a format that is suitable for :func load.
+        The properties are written in large chunks rather than line by line.
+        :param out: The stream/writer to store the properties. This must be a file or derived class from IOBase or StringIO. Defaults to sys.stdout
+        :param sort: If True then the properties are written in the key sorted order, otherwise in the (faster) order of the dictionary.
+        :param includeDefaults: If True then the properties of the default properties are written too, otherwise only the local properties.
+        :param escape: If True then the keys and values are escaped, see :py:func:`__escape`, so that :py:func:`load` with unescape=True reads
+        back exactly the same properties, str or unicode, from a byte stream. By default they are written as they are.
+        The str keys and values are taken as UTF-8 encoded text, see :py:func:`__writeLines`.
+        """
+        if not Properties.__isWritable(out):
+            raise TypeError('Provided stream/writer is not derived from IOBase or not is StringIO or not a writable file.')
+        properties = self.getAllProps() if includeDefaults else self.__properties
+        keys = sorted(properties) if sort else properties
+        chunk = []
+        for key in keys:
+            if escape:
+                chunk.append(Properties.__escape(key) + '=' + Properties.__escape(properties[key]) + '\n')
+            else:
+                chunk.append(key + '=' + properties[key] + '\n')
+            if len(chunk) >= 1024:
+                Properties.__writeLines(out, chunk)
+                chunk = []
+        if chunk:
+            Properties.__writeLines(out, chunk)
+
+    @staticmethod
+    def __writeLines(out, lines):
+        """
+        Writes the :param lines on :param out, as unicode on a text stream and as bytes on the other streams. The str lines, which hold UTF-8
+        encoded text, are decoded for the text streams and written as they are on the others, the unicode lines are encoded in UTF-8.
+        """
+        from io import TextIOBase
+        try:
+            text = ''.join(lines)
+        except UnicodeDecodeError:  # Non ASCII str mixed with unicode.
+            text = u''.join(_decodeText(line) for line in lines)
+        if isinstance(out, TextIOBase):
+            out.write(_decodeText(text))
+        else:
+            out.write(text.encode('utf-8') if text.__class__ is unicode else text)
+
+    def storeToFile(self, fName, sort=True, includeDefaults=False, escape=False):
+        """
+        Writes the properties in the file :param fName, see :py:func:`store`. The file is replaced atomically: the properties are written in a
+        temporary file which is renamed to :param fName once complete, so that readers never see a partially written file.
+        """
+        Properties.__writeAtomically(fName, lambda propFile: self.store(propFile, sort, includeDefaults, escape), 'w')
+
+
+
+def _intern(key):
+    """
+    Returns the interned :param key, so that the properties holding the same keys share the key strings. Only str keys can be interned.
+    """
+    return intern(key) if key.__class__ is str else key
+
+
+def _decodeText(s):
+    """
+    Returns :param s as unicode, a str being taken as UTF-8 encoded text.
+    """
+    return s.decode('utf-8') if s.__class__ is str else s
+
+
+def _encodeShared(s):
+    """
+    Returns the bytes :param s is stored as in a shared properties file, and True if it is unicode.
+    """
+    return (s.encode('utf-8'), True) if isinstance(s, unicode) else (s, False)
+
+
+def _packShared(values, expanded):
+    """
+    Returns the content of the shared properties file holding the :param values and the :param expanded values, see
+    :py:func:`Properties.publish`. The file starts with a header, followed by the entries sorted by key, the open addressing hash index of
+    the keys and the strings, each distinct string being stored once.
+    """
+    encoded = sorted((_encodeShared(key), key) for key in values)
+    tableSize = 8
+    while tableSize < 2 * len(encoded):
+        tableSize <<= 1
+    table = [0] * tableSize
+    offsets = {}    # Bytes of a string -> offset in the file.
+    strings = []
+    size = [_SHARED_HEADER.size + len(encoded) * _SHARED_ENTRY.size + tableSize * _SHARED_SLOT.size]
+
+    def store(data):
+        offset = offsets.get(data)
+        if offset is None:
+            offset = offsets[data] = size[0]
+            strings.append(data)
+            size[0] += len(data)
+        return offset
+
+    entries = []
+    for i, ((keyData, keyUnicode), key) in enumerate(encoded):
+        valueData, valueUnicode = _encodeShared(values[key])
+        if key in expanded:
+            expandedData, expandedUnicode = _encodeShared(expanded[key])
+            expandedOffset = store(expandedData)
+        else:
+            expandedData, expandedUnicode, expandedOffset = '', False, _SHARED_ABSENT
+        entries.append(_SHARED_ENTRY.pack(store(keyData), len(keyData), store(valueData), len(valueData), expandedOffset, len(expandedData),
+                                          keyUnicode | valueUnicode << 1 | expandedUnicode << 2))
+        slot = zlib.crc32(keyData) & (tableSize - 1)
+        while table[slot]:
+            slot = (slot + 1) & (tableSize - 1)
+        table[slot] = i + 1
+    header = _SHARED_HEADER.pack(_SHARED_MAGIC, len(encoded), tableSize, 0)
+    return ''.join([header] + entries + [struct.pack('<%dI' % tableSize, *table)] + strings)
+
+
+def _loadPropertiesFile(fName):
+    """
+    Returns the local property list loaded from the file :param fName, the worker function of :py:func:`Properties.mergePropertiesFiles`.
+    """
+    return Properties.createPropertiesFromPropertiesFile(fName).properties
+
+
+class _ReadOnlyPropertyDict(DictMixin, object):
+    """
+    Read only dictionary protocol of the property list views. The views implement __getitem__, __contains__, __iter__ and __len__, and
+    :py:class:`UserDict.DictMixin` derives the other methods of a dictionary from them. The mutations raise TypeError.
+    """
+
+    def __setitem__(self, key, value):
+        raise TypeError('The properties are read-only.')
+
+    def __delitem__(self, key):
+        raise TypeError('The properties are read-only.')
+
+    def update(self, *args, **kwargs):
+        raise TypeError('The properties are read-only.')
+
+    def keys(self):
+        return list(self)
+
+
+class _ReadOnlyProperties(Properties):
+    """
+    Base class of the read only properties, whose local property list is a view, see :py:class:`_ReadOnlyPropertyDict`. The methods changing
+    the local property list raise TypeError.
+    """
+
+    __slots__ = ()
+
+    def load(self, inStream=sys.stdin, unescape=False):
+        raise TypeError('%s are read-only.' % self.__class__.__name__)
+
+    def loadFromXML(self, inStream=sys.stdin):
+        raise TypeError('%s are read-only.' % self.__class__.__name__)
+
+    def reload(self, inStream=None, unescape=False):
+        raise TypeError('%s are read-only.' % self.__class__.__name__)
+
+    def loadEntries(self, entries):
+        raise TypeError('%s are read-only.' % self.__class__.__name__)
+
+    def setProperty(self, key, value):
+        raise TypeError('%s are read-only.' % self.__class__.__name__)
+
+
+class _MappedReader(object):
+    """
+    Minimal read only stream over a memory mapped buffer, starting at a given offset. Lets :py:func:`Properties.iterParse` read the buffer
+    without copying it as a whole.
+    """
+
+    def __init__(self, buffer, offset=0, blockSize=_BLOCK_SIZE):
+        self.__buffer = buffer
+        self.__offset = offset
+        self.__blockSize = blockSize
+
+    def read(self, size=-1):
+        end = len(self.__buffer) if size < 0 else self.__offset + min(size, self.__blockSize)
+        block = self.__buffer[self.__offset:end]
+        self.__offset += len(block)
+        return block
+
+
+class _MappedPropertyDict(_ReadOnlyPropertyDict):
+    """
+    Read only dictionary like view of a memory mapped property file. Only a compact index of the keys is kept in memory, arrays of the hashes
+    of the keys and of the offsets of their properties and a hash table of their positions in these arrays, no key is. A key is looked up by
+    its hash, and compared with the key parsed from the mapped file at the offset. A value is parsed from the mapped file the first time it is
+    accessed.
+    """
+
+    def __init__(self, fName, unescape=False):
+        self.__unescape = unescape
+        self.__values = {}      # Values of the keys accessed so far.
+        with open(fName, 'rb') as propFile:
+            if os.fstat(propFile.fileno()).st_size:
+                self.__map = mmap.mmap(propFile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:   # Empty files can not be mapped.
+                self.__map = ''
+        self.__hashes, self.__offsets, self.__slots = self.__buildIndex()
+        self.__length = sum(1 for position in self.__slots if position != -1)
+
+    def __scan(self):
+        """
+        Yields the (key, value, offset) tuples of the properties in the mapped file, in file order, offset being the one of the line the
+        property starts at.
+        """
+        lineBreaks = _LINE_BREAK_PATTERN.finditer(self.__map)
+        lineNumber = offset = 0    # Number of line breaks passed and the offset of the line after the last one.
+        for key, value, startLineNumber in Properties.iterParse(_MappedReader(self.__map), self.__unescape):
+            while lineNumber < startLineNumber - 1:
+                offset = next(lineBreaks).end()
+                lineNumber += 1
+            yield key, value, offset
+
+    def __entry(self, offset):
+        """
+        Returns the (key, value) of the property starting at :param offset in the mapped file.
+        """
+        return next(Properties.iterParse(_MappedReader(self.__map, offset, 512), self.__unescape))[:2]
+
+    def __buildIndex(self):
+        """
+        Returns the arrays of the hashes of the keys in the mapped file and of the offsets of the lines their properties start at, in file
+        order, and the open addressing hash table of the positions in these arrays of the keys, with linear probing. A key defined more than
+        once is indexed at its last definition only, whose value :py:func:`Properties.load` keeps.
+        """
+        hashes = array('l')
+        offsets = array('l')
+        for key, _, offset in self.__scan():
+            hashes.append(hash(key))
+            offsets.append(offset)
+        size = 8
+        while size * 3 < len(hashes) * 4:  # Load factor of at most 3/4.
+            size <<= 1
+        slots = array('i', [-1]) * size
+        mask = size - 1
+        for position, h in enumerate(hashes):
+            i = h & mask
+            while slots[i] != -1:
+                other = slots[i]
+                if hashes[other] == h and self.__entry(offsets[other])[0] == self.__entry(offsets[position])[0]:  # Redefined key.
+                    break
+                i = (i + 1) & mask
+            slots[i] = position
+        return hashes, offsets, slots
+
+    def __position(self, key):
+        """
+        Returns the position of :param key in the arrays of the index, -1 if the mapped file does not define it.
+        """
+        h = hash(key)
+        hashes, slots = self.__hashes, self.__slots
+        mask = len(slots) - 1
+        i = h & mask
+        position = slots[i]
+        while position != -1:
+            if hashes[position] == h and self.__entry(self.__offsets[position])[0] == key:
+                return position
+            i = (i + 1) & mask
+            position = slots[i]
+        return -1
+
+    def __indexed(self, position):
+        """
+        Returns True if the property at :param position in the arrays of the index is the indexed definition of its key, i.e. its last one.
+        """
+        slots = self.__slots
+        mask = len(slots) - 1
+        i = self.__hashes[position] & mask
+        while slots[i] != -1:
+            if slots[i] == position:
+                return True
+            i = (i + 1) & mask
+        return False
+
+    def __lookup(self, key):
+        """
+        Returns the value of :param key, parsed from the mapped file on the first access, or _MISSING if the mapped file does not define it.
+        """
+        value = self.__values.get(key, _MISSING)
+        if value is _MISSING:
+            position = self.__position(key)
+            if position != -1:
+                value = self.__values[key] = self.__entry(self.__offsets[position])[1]
+        return value
+
+    def close(self):
+        """
+        Closes the memory mapped file, the values not accessed so far can not be accessed anymore.
+        """
+        if self.__map:
+            self.__map.close()
+
+    def __getitem__(self, key):
+        value = self.__lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.__lookup(key) is not _MISSING
+
+    def __len__(self):
+        return self.__length
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def iteritems(self):
+        """
+        Yields the (key, value) of the properties, parsed again from the mapped file in a single pass. The keys defined more than once are
+        yielded at their last definition only.
+        """
+        for position, (key, value, _) in enumerate(self.__scan()):
+            if self.__indexed(position):
+                yield key, value
+
+    def get(self, key, default=None):
+        value = self.__lookup(key)
+        return value if value is not _MISSING else default
+
+
+class MappedProperties(_ReadOnlyProperties):
+    """
+    Read only Properties backed by a memory mapped property file. Opening the file builds a compact index of the hashes and offsets of the
+    keys, about 24 bytes per key, the keys and values are parsed only when they are asked for through :py:func:`getProperty` or
+    :py:func:`getExpandedProperty`. The resident memory therefore grows with the number of keys accessed rather than with the size of the file.
+    Use :py:func:`close` to unmap the file.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, fName, defaultProperty=None, unescape=False):
+        """
+        Maps the property file and indexes its keys.
+        :param fName: The property file to map.
+        :param defaultProperty: The property list that is to be used as the default property list, by default there are no default properties.
+        :param unescape: If True then the escape sequences in the keys and values are replaced, see :py:func:`Properties.load`.
+        """
+        Properties.__init__(self, defaultProperty)
+        self.properties = _MappedPropertyDict(fName, unescape)
+
+    def close(self):
+        """
+        Unmaps the property file.
+        """
+        self.properties.close()
+
+
+class _PackedPropertyDict(object):
+    """
+    Compact dictionary like property list, the keys are kept sorted in a tuple and the values in a parallel tuple, and looked up by binary
+    search. A few properties take a fraction of the memory of a dictionary, but every change copies the tuples. The mutations are recorded
+    as those of :py:class:`_PropertyDict` are.
+    """
+
+    __slots__ = ('__keys', '__values', '__version')
+
+    def __init__(self, properties=()):
+        self.__keys = self.__values = ()
+        self.__version = 0
+        if properties:
+            self.update(properties)
+
+    def stamp(self):
+        """
+        Returns the version of the property list, which changes on every mutation.
+        """
+        return self.__version
+
+    def __find(self, key):
+        """
+        Returns the position of :param key in the sorted keys, or -1 if it is not there.
+        """
+        keys = self.__keys
+        i = bisect.bisect_left(keys, key)
+        return i if i < len(keys) and keys[i] == key else -1
+
+    def __getitem__(self, key):
+        i = self.__find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.__values[i]
+
+    def __setitem__(self, key, value):
+        keys, values = self.__keys, self.__values
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            self.__values = values[:i] + (value,) + values[i+1:]
+        else:
+            self.__keys = keys[:i] + (_intern(key),) + keys[i:]
+            self.__values = values[:i] + (value,) + values[i:]
+        self.__version = _nextVersion()
+
+    def __delitem__(self, key):
+        i = self.__find(key)
+        if i < 0:
+            raise KeyError(key)
+        self.__keys = self.__keys[:i] + self.__keys[i+1:]
+        self.__values = self.__values[:i] + self.__values[i+1:]
+        self.__version = _nextVersion()
+
+    def __contains__(self, key):
+        return self.__find(key) >= 0
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __iter__(self):
+        return iter(self.__keys)
+
+    def get(self, key, default=None):
+        i = self.__find(key)
+        return self.__values[i] if i >= 0 else default
+
+    def keys(self):
+        return list(self.__keys)
+
+    def iterkeys(self):
+        return iter(self.__keys)
+
+    def iteritems(self):
+        return iter(zip(self.__keys, self.__values))
+
+    def items(self):
+        return zip(self.__keys, self.__values)
+
+    def update(self, *args, **kwargs):
+        entries = dict(zip(self.__keys, self.__values))
+        entries.update(*args, **kwargs)
+        keys = sorted(entries)
+        self.__keys = tuple(_intern(key) for key in keys)
+        self.__values = tuple(entries[key] for key in keys)
+        self.__version = _nextVersion()
+
+
+class _OverlayIndex(object):
+    """
+    Lookup index of an :py:class:`OverlayProperties`, a view over the lookup index of its default properties and its packed overrides, see
+    :py:func:`Properties.__lookupIndex`. The index of the default properties is shared by all the overlays, nothing is copied.
+    """
+
+    __slots__ = ('__index', '__overrides')
+
+    def __init__(self, index, overrides):
+        self.__index = index
+        self.__overrides = overrides
+
+    def __getitem__(self, key):
+        return self.__overrides if key in self.__overrides else self.__index[key]
+
+    def __contains__(self, key):
+        return key in self.__overrides or key in self.__index
+
+    def __len__(self):
+        return len(self.__index) + sum(1 for key in self.__overrides if key not in self.__index)
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def get(self, key, default=None):
+        return self.__overrides if key in self.__overrides else self.__index.get(key, default)
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        index, overrides = self.__index, self.__overrides
+        for key, properties in index.iteritems():
+            yield (key, overrides if key in overrides else properties)
+        for key in overrides:
+            if key not in index:
+                yield (key, overrides)
+
+
+class OverlayProperties(Properties):
+    """
+    Properties holding only the keys overridden on top of shared default properties, e.g. one overlay per tenant over the common configuration.
+    The overridden keys are packed, see :py:class:`_PackedPropertyDict`, and the other keys are looked up in the flattened index of the default
+    properties, which is built once and shared by all the overlays, as are the sorted keys of the namespace queries. The memory of an overlay
+    thus grows with its number of overrides rather than with the size of the default properties. Every change copies the packed overrides,
+    overlays are meant for few, rarely changed keys.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, defaultProperty=None, overrides=None):
+        """
+        Creates an overlay over the default properties.
+        :param defaultProperty: The shared property list that is to be used as the default property list.
+        :param overrides: Optional dictionary of the overridden key/values.
+        """
+        Properties.__init__(self, defaultProperty)
+        self.properties = _PackedPropertyDict(overrides)
+
+    def copy(self):
+        """
+        Returns a copy of the overlay, over the same default properties.
+        """
+        return OverlayProperties(self.defaults, self.properties)
+
+
+class _SharedPropertyDict(_ReadOnlyPropertyDict):
+    """
+    Read only dictionary like view of a shared properties file, see :py:func:`Properties.publish`. The file is memory mapped, keys are
+    found through its hash index and the keys and values are read from the mapped file on every access, nothing is kept in memory.
+    """
+
+    def __init__(self, fName):
+        with open(fName, 'rb') as sharedFile:
+            self.__map = mmap.mmap(sharedFile.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.__map) < _SHARED_HEADER.size or _SHARED_HEADER.unpack_from(self.__map, 0)[0] != _SHARED_MAGIC:
+            self.__map.close()
+            raise ValueError('%s is not a shared properties file.' % fName)
+        _, self.__count, tableSize, _ = _SHARED_HEADER.unpack_from(self.__map, 0)
+        self.__mask = tableSize - 1
+        self.__tableOffset = _SHARED_HEADER.size + self.__count * _SHARED_ENTRY.size
+
+    def close(self):
+        """
+        Unmaps the shared properties file.
+        """
+        self.__map.close()
+
+    def __entry(self, i):
+        return _SHARED_ENTRY.unpack_from(self.__map, _SHARED_HEADER.size + i * _SHARED_ENTRY.size)
+
+    def __string(self, offset, length, isUnicode):
+        data = self.__map[offset:offset + length]
+        return data.decode('utf-8') if isUnicode else data
+
+    def __find(self, key):
+        """
+        Returns the entry of :param key, None if it is not in the file.
+        """
+        if not isinstance(key, basestring):
+            return None
+        data = _encodeShared(key)[0]
+        sharedMap = self.__map
+        slot = zlib.crc32(data) & self.__mask
+        while True:
+            i = _SHARED_SLOT.unpack_from(sharedMap, self.__tableOffset + slot * _SHARED_SLOT.size)[0]
+            if not i:
+                return None
+            entry = self.__entry(i - 1)
+            if entry[1] == len(data) and sharedMap[entry[0]:entry[0] + entry[1]] == data:
+                return entry
+            slot = (slot + 1) & self.__mask
+
+    def getExpanded(self, key):
+        """
+        Returns the published expanded value of :param key, None if the key is not in the file or its expanded value was not published.
+        """
+        entry = self.__find(key)
+        if entry is None or entry[4] == _SHARED_ABSENT:
+            return None
+        return self.__string(entry[4], entry[5], entry[6] & 4)
+
+    def __getitem__(self, key):
+        entry = self.__find(key)
+        if entry is None:
+            raise KeyError(key)
+        return self.__string(entry[2], entry[3], entry[6] & 2)
+
+    def __contains__(self, key):
+        return self.__find(key) is not None
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        for i in xrange(self.__count):
+            entry = self.__entry(i)
+            yield self.__string(entry[0], entry[1], entry[6] & 1)
+
+    def get(self, key, default=None):
+        entry = self.__find(key)
+        return self.__string(entry[2], entry[3], entry[6] & 2) if entry is not None else default
+
+    def iteritems(self):
+        for i in xrange(self.__count):
+            entry = self.__entry(i)
+            yield (self.__string(entry[0], entry[1], entry[6] & 1), self.__string(entry[2], entry[3], entry[6] & 2))
+
+
+class SharedProperties(_ReadOnlyProperties):
+    """
+    Read only Properties attached to a file published by :py:func:`Properties.publish`, typically in shared memory. The file is memory mapped,
+    so that all the processes attached to it share its pages, and nothing is parsed: the keys are found through the hash index of the file
+    and the values are read from it when they are asked for. Use :py:func:`close` to detach.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, fName, defaultProperty=None):
+        """
+        Attaches to the shared properties file.
+        :param fName: The file the properties were published in.
+        :param defaultProperty: The property list that is to be used as the default property list, by default there are no default properties.
+        """
+        Properties.__init__(self, defaultProperty)
+        self.properties = _SharedPropertyDict(fName)
+
+    def close(self):
+        """
+        Detaches from the shared properties file.
+        """
+        self.properties.close()
+
+    def getExpandedProperty(self, key, defaultValue=None, formatter=None):
+        """
+        Returns the published expanded value of :param key, see :py:func:`Properties.publish`, otherwise expands the value as
+        :py:func:`Properties.getExpandedProperty` does.
+        """
+        expanded = self.properties.getExpanded(key)
+        if expanded is None:
+            return Properties.getExpandedProperty(self, key, defaultValue, formatter)
+        if formatter and not callable(formatter):
+            raise TypeError('formatter is not callable.')
+        return formatter(expanded) if formatter else expanded
+
+
+class _MergedPropertyDict(_ReadOnlyPropertyDict):
+    """
+    Read only dictionary like view of the properties (key/values) of several properties and their default properties, later properties taking
+    precedence over the earlier ones. The keys are resolved on demand through the lookup indexes of the properties, optionally through a
+    flattened index of all of them which is rebuilt only after one of the properties has changed. Nothing is copied.
+    """
+
+    def __init__(self, propertiesList, indexed=False):
+        self.__propertiesList = list(reversed(propertiesList))  # By decreasing precedence.
+        self.__indexed = indexed
+        self.__index = None         # key -> local property dictionary holding it, see :py:func:`__flattenedIndex`.
+        self.__indexStamp = None
+        self.__indexClock = -1
+
+    def stamp(self):
+        """
+        Returns a stamp identifying the current state of the merged properties.
+        """
+        return tuple(properties._lookupIndexWithStamp()[1] for properties in self.__propertiesList)
+
+    def __flattenedIndex(self):
+        """
+        Returns the dictionary mapping every key to the local property dictionary it is resolved from. The index is cached if the view is
+        indexed, otherwise it is built on every call.
+        """
+        clock = _mutationCount
+        if self.__indexed and self.__indexClock == clock:
+            return self.__index
+        indexes = [properties._lookupIndexWithStamp() for properties in self.__propertiesList]
+        stamp = tuple(indexStamp for _, indexStamp in indexes)
+        if not self.__indexed or stamp != self.__indexStamp:
+            index = {}
+            for propertiesIndex, _ in reversed(indexes):
+                index.update(propertiesIndex)
+            if not self.__indexed:
+                return index
+            self.__index = index
+            self.__indexStamp = stamp
+        self.__indexClock = clock
+        return self.__index
+
+    def __resolve(self, key):
+        """
+        Returns the local property dictionary holding :param key with the highest precedence, None if no properties holds it.
+        """
+        if self.__indexed:
+            return self.__flattenedIndex().get(key)
+        for properties in self.__propertiesList:
+            localProperties = properties._lookupIndexWithStamp()[0].get(key)
+            if localProperties is not None:
+                return localProperties
+        return None
+
+    def __getitem__(self, key):
+        localProperties = self.__resolve(key)
+        if localProperties is None:
+            raise KeyError(key)
+        return localProperties[key]
+
+    def __contains__(self, key):
+        return self.__resolve(key) is not None
+
+    def __len__(self):
+        return len(self.__flattenedIndex())
+
+    def __iter__(self):
+        return iter(self.__flattenedIndex())
+
+    def get(self, key, default=None):
+        localProperties = self.__resolve(key)
+        return localProperties[key] if localProperties is not None else default
+
+    def iteritems(self):
+        for key, localProperties in self.__flattenedIndex().iteritems():
+            yield (key, localProperties[key])
+
+    def copy(self):
+        """
+        Returns a dictionary holding a copy of the merged properties. The dictionary is updated with the local property lists of every merged
+        properties and its default properties, from the lowest to the highest precedence, each value is copied once. The dictionary is a
+        :py:class:`_PropertyDict`, which :py:func:`MergedProperties.materialize` does not need to copy again.
+        """
+        merged = _PropertyDict()
+        for properties in reversed(self.__propertiesList):
+            layers = []
+            while properties is not None:
+                layers.append(properties.properties)
+                properties = properties.defaults
+            for layer in reversed(layers):
+                merged.update(layer)
+        return merged
+
+
+class MergedProperties(_ReadOnlyProperties):
+    """
+    Read only view merging several properties and their default properties, with the precedence of :py:func:`Properties.mergeProperties`:
+    later properties override the earlier ones, and the local properties of each override its default properties. The view keeps references
+    to the merged properties and resolves the keys on demand, so it reflects their later changes and costs nothing to create. Use
+    :py:func:`materialize` to copy the merged properties into a plain properties.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, propertiesList, indexed=False, defaultProperty=None):
+        """
+        Creates the view.
+        :param propertiesList: The properties to merge, in precedence order.
+        :param indexed: If True then the keys are resolved through a flattened index of all the merged properties, built on first use and
+        after every change of the merged properties. Faster lookups when merging many properties, at the cost of a dictionary of all the keys.
+        :param defaultProperty: The property list that is to be used as the default property list of the view.
+        """
+        Properties.__init__(self, defaultProperty)
+        self.properties = _MergedPropertyDict(propertiesList, indexed)
+
+    def materialize(self):
+        """
+        Returns a properties holding a copy of the merged properties, with the default properties of the view.
+        """
+        prop = Properties(self.defaults)
+        prop.properties = self.properties.copy()
+        return prop
+
+
+class ConcurrentProperties(object):
+    """
+    Thread safe properties. Readers work on an immutable snapshot, a Properties which is never modified once published, without taking any
+    lock: every attribute and method not defined here, e.g. :py:func:`Properties.getProperty` or :py:func:`Properties.getExpandedProperty`, is
+    looked up on the current snapshot. Writers (:py:func:`setProperty`, :py:func:`load`, :py:func:`reload` etc.) are serialized by a lock, apply
+    their change to a copy of the current snapshot and publish the copy with a single, atomic, assignment. Writes therefore cost a copy of the
+    local property list and start with empty caches, they are meant to be much rarer than reads.
+    Use :py:func:`snapshot` to read several values from the same consistent state. The default properties should be immutable or concurrent
+    properties as well.
+    """
+
+    def __init__(self, defaultProperty=None):
+        """
+        Creates an empty concurrent property list with defaults.
+        :param defaultProperty: The property list that is to be used as the default property list, by default there are no default properties.
+        """
+        self.__snapshot = Properties(defaultProperty)
+        self.__snapshot._allocateCaches()
+        import threading
+        self.__lock = threading.Lock()
+        self.__listeners = []
+
+    @staticmethod
+    def fromProperties(properties):
+        """
+        Returns concurrent properties starting with a copy of :param properties, see :py:func:`Properties.copy`.
+        """
+        concurrentProperties = ConcurrentProperties()
+        snapshot = properties.copy()
+        snapshot._allocateCaches()
+        concurrentProperties.__snapshot = snapshot
+        return concurrentProperties
+
+    def __getattr__(self, name):
+        if name.startswith('_ConcurrentProperties__'):  # Not initialized yet.
+            raise AttributeError(name)
+        return getattr(self.__snapshot, name)
+
+    def snapshot(self):
+        """
+        Returns the current snapshot, a Properties which must not be modified.
+        """
+        return self.__snapshot
+
+    def __write(self, change):
+        """
+        Applies :param change to a copy of the current snapshot and publishes the copy. Returns the result of :param change.
+        """
+        with self.__lock:
+            snapshot = self.__snapshot.copy()
+            result = change(snapshot)
+            snapshot._allocateCaches()  # The readers never allocate them concurrently.
+            self.__snapshot = snapshot
+            _nextVersion()  # The readers which validated their caches against the previous snapshot meanwhile validate them again.
+        return result
+
+    @property
+    def defaults(self):
+        """
+        The default properties of the current snapshot.
+        """
+        return self.__snapshot.defaults
+
+    @defaults.setter
+    def defaults(self, defaultProperty):
+        self.__write(lambda snapshot: setattr(snapshot, 'defaults', defaultProperty))
+
+    @property
+    def properties(self):
+        """
+        The local property list of the current snapshot, which must not be modified.
+        """
+        return self.__snapshot.properties
+
+    def setProperty(self, key, value):
+        """
+        Puts the key/value pair in the properties list, see :py:func:`Properties.setProperty`.
+        """
+        self.__write(lambda snapshot: snapshot.setProperty(key, value))
+
+    def load(self, inStream=sys.stdin, unescape=False):
+        """
+        Reads a property list (key/value) from input stream, see :py:func:`Properties.load`. Readers see either none or all of the properties.
+        """
+        self.__write(lambda snapshot: snapshot.load(inStream, unescape))
+
+    def loadEntries(self, entries):
+        """
+        Stores the parsed entries, see :py:func:`Properties.loadEntries`. Readers see either none or all of the properties.
+        """
+        self.__write(lambda snapshot: snapshot.loadEntries(entries))
+
+    def loadFromXML(self, inStream=sys.stdin):
+        """
+        Loads all the properties in the XML document on the given input stream, see :py:func:`Properties.loadFromXML`.
+        """
+        self.__write(lambda snapshot: snapshot.loadFromXML(inStream))
+
+    def addListener(self, listener):
+        """
+        Registers :param listener to be notified of the changes made by :py:func:`reload`, see :py:func:`Properties.addListener`.
+        """
+        self.__listeners.append(listener)
+
+    def removeListener(self, listener):
+        """
+        Unregisters a listener registered by :py:func:`addListener`.
+        """
+        self.__listeners.remove(listener)
+
+    def reload(self, inStream=None, unescape=False):
+        """
+        Re-reads the property list and publishes a snapshot with the changes, see :py:func:`Properties.reload`. The listeners are notified once
+        the new snapshot is published.
+        """
+        diff = self.__write(lambda snapshot: snapshot.reload(inStream, unescape))
+        if diff.added or diff.changed or diff.removed:
+            for listener in list(self.__listeners):
+                listener(self, diff)
+        return diff
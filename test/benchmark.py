@@ -0,0 +1,278 @@
+'''
+Benchmarks for the properties module, run from the test directory:
+
+    python benchmark.py run [--size 10000] [--depth 8] [--references 0.3] [--continuations 0.05] [--output results.json]
+    python benchmark.py compare baseline.json results.json [--threshold 0.2]
+    python benchmark.py concurrency
+
+run measures the throughput (properties handled per second, best of the repetitions) and the peak memory (increase of the maximum resident
+set size) of every operation on synthetic properties, each operation in a process of its own. compare reports the operations of a run that
+are slower or use more memory than in a baseline run by more than the threshold, and exits with status 1 if there are any.
+'''
+import argparse
+import gc
+import io
+import json
+import multiprocessing
+import random
+import resource
+import StringIO
+import sys
+import threading
+import time
+
+import properties as p
+
+
+def generateEntries(size, referenceDensity=0.3, seed=0):
+    """
+    Returns :param size (key, value) tuples. A :param referenceDensity fraction of the values reference one to three of the keys generated
+    before, so that the references nest.
+    """
+    rand = random.Random(seed)
+    entries = []
+    for i in range(size):
+        value = 'value%d' % i
+        if i and rand.random() < referenceDensity:
+            value += ''.join('-${key%d}' % rand.randrange(i) for _ in range(rand.randint(1, 3)))
+        entries.append(('key%d' % i, value))
+    return entries
+
+
+def formatProperties(entries, continuationFrequency=0.05, seed=0):
+    """
+    Returns the property file of the (key, value) :param entries, a :param continuationFrequency fraction of the properties is continued on
+    a second line.
+    """
+    rand = random.Random(seed)
+    lines = []
+    for key, value in entries:
+        line = '%s=%s' % (key, value)
+        if rand.random() < continuationFrequency:
+            i = rand.randint(len(key) + 1, len(line) - 1)
+            line = line[:i] + '\\\n    ' + line[i:]
+        lines.append(line + '\n')
+    return ''.join(lines)
+
+
+def generateDefaultsChain(entries, depth):
+    """
+    Returns the top of a defaults chain of :param depth properties, the :param entries are spread over the layers and every tenth key is
+    overridden by the layer above the one holding it.
+    """
+    layers = [p.Properties()]
+    for _ in range(1, depth):
+        layers.append(p.Properties(layers[-1]))
+    for i, (key, value) in enumerate(entries):
+        layer = i % depth
+        layers[layer].setProperty(key, value)
+        if i % 10 == 0 and layer + 1 < depth:
+            layers[layer + 1].setProperty(key, value + '-override')
+    return layers[-1]
+
+
+def setupLoad(options):
+    text = formatProperties(generateEntries(options.size, options.references), options.continuations)
+    return (lambda: p.Properties().load(io.BytesIO(text))), options.size
+
+
+def setupGetProperty(options):
+    top = generateDefaultsChain(generateEntries(options.size, options.references), options.depth)
+    keys = ['key%d' % i for i in range(options.size)] + ['missing%d' % i for i in range(options.size // 10)]
+
+    def run():
+        for key in keys:
+            top.getProperty(key)
+    return run, len(keys)
+
+
+def setupGetExpandedProperty(options):
+    top = generateDefaultsChain(generateEntries(options.size, options.references), options.depth)
+    keys = ['key%d' % i for i in range(options.size)]
+
+    def run():
+        prop = top.copy()   # Starts with empty caches.
+        for key in keys:
+            prop.getExpandedProperty(key)
+    return run, len(keys)
+
+
+def setupExpandAll(options):
+    top = generateDefaultsChain(generateEntries(options.size, options.references), options.depth)
+    return (lambda: top.copy().expandAll()), options.size
+
+
+def setupMergeProperties(options):
+    entries = generateEntries(options.size, options.references)
+    chains = [generateDefaultsChain(entries[i::4], options.depth) for i in range(4)]
+    return (lambda: p.Properties.mergeProperties(chains)), options.size
+
+
+def setupStore(options):
+    prop = p.Properties()
+    prop.load(io.BytesIO(formatProperties(generateEntries(options.size, options.references), 0)))
+    return (lambda: prop.store(StringIO.StringIO())), options.size
+
+
+BENCHMARKS = [('load', setupLoad), ('getProperty', setupGetProperty), ('getExpandedProperty', setupGetExpandedProperty),
+              ('expandAll', setupExpandAll), ('mergeProperties', setupMergeProperties), ('store', setupStore)]
+
+
+def measure(setup, options, results):
+    """
+    Runs the operation returned by :param setup :param options.repeat times and puts its best throughput and peak memory in :param results.
+    """
+    run, count = setup(options)
+    gc.collect()
+    baseMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _ in range(options.repeat):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseMemory
+    if sys.platform == 'darwin':    # ru_maxrss is in bytes rather than KiB.
+        peakMemory //= 1024
+    results.put({'throughput': count / max(best, 1e-9), 'peakMemory': peakMemory})
+
+
+def runBenchmarks(options):
+    """
+    Runs every benchmark in a process of its own, so that the peak memory of an operation is not hidden by the previous ones, and returns
+    the results keyed by the operation.
+    """
+    results = {}
+    print '%-20s %16s %16s' % ('operation', 'throughput/s', 'peak memory KiB')
+    for name, setup in BENCHMARKS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(setup, options, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+        print '%-20s %16d %16d' % (name, results[name]['throughput'], results[name]['peakMemory'])
+    return results
+
+
+def compareResults(baseline, current, threshold=0.2, memorySlack=1024):
+    """
+    Returns the regressions of the :param current results against the :param baseline results, as (operation, metric, baseline value,
+    current value) tuples: the throughput dropped by more than :param threshold, or the peak memory grew by more than :param threshold and
+    more than :param memorySlack KiB, which absorbs the noise of the allocator.
+    """
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        if after['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append((name, 'throughput', before['throughput'], after['throughput']))
+        if after['peakMemory'] > max(before['peakMemory'] * (1 + threshold), before['peakMemory'] + memorySlack):
+            regressions.append((name, 'peakMemory', before['peakMemory'], after['peakMemory']))
+    return regressions
+
+
+def measureReads(read, keyCount, threadCount, duration):
+    """
+    Runs :param threadCount threads calling :param read on the keys for :param duration seconds, returns the total number of reads per second.
+    """
+    counts = [0] * threadCount
+    stop = []
+
+    def reader(n):
+        keys = ['key%d' % ((i * 7 + n) % keyCount) for i in range(keyCount)]
+        count = 0
+        while not stop:
+            for key in keys:
+                read(key)
+            count += len(keys)
+        counts[n] = count
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(threadCount)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.append(True)
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.time() - start)
+
+
+def benchmarkConcurrentReads(threadCounts=(1, 2, 4, 8, 16), keyCount=1000, duration=1.0):
+    """
+    Compares the read throughput of ConcurrentProperties, whose readers take no lock, with readers serialized by a lock, under a growing number
+    of reader threads while a writer publishes a new snapshot every 10ms.
+    """
+    base = p.Properties()
+    base.load(io.BytesIO(formatProperties(generateEntries(keyCount), 0)))
+    prop = p.ConcurrentProperties.fromProperties(base)
+    lock = threading.Lock()
+
+    def lockFreeRead(key):
+        return prop.getExpandedProperty(key)
+
+    def lockedRead(key):
+        with lock:
+            return prop.getExpandedProperty(key)
+
+    stop = []
+
+    def writer():
+        i = 0
+        while not stop:
+            prop.setProperty('key0', 'value0-%d' % i)
+            i += 1
+            time.sleep(0.01)
+
+    writerThread = threading.Thread(target=writer)
+    writerThread.start()
+    try:
+        print '%8s %16s %16s' % ('threads', 'lock-free reads/s', 'locked reads/s')
+        for threadCount in threadCounts:
+            print '%8d %16d %16d' % (threadCount, measureReads(lockFreeRead, keyCount, threadCount, duration),
+                                     measureReads(lockedRead, keyCount, threadCount, duration))
+    finally:
+        stop.append(True)
+        writerThread.join()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the properties module.')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='Measure the throughput and peak memory of every operation.')
+    run.add_argument('--size', type=int, default=10000, help='Number of properties.')
+    run.add_argument('--depth', type=int, default=8, help='Length of the defaults chains.')
+    run.add_argument('--references', type=float, default=0.3, help='Fraction of the values referencing other keys.')
+    run.add_argument('--continuations', type=float, default=0.05, help='Fraction of the properties continued on the next line.')
+    run.add_argument('--repeat', type=int, default=5, help='Number of repetitions, the best one is reported.')
+    run.add_argument('--output', help='File the results are written to, as JSON.')
+    compare = commands.add_parser('compare', help='Report the regressions of a run against a baseline run.')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.2, help='Tolerated relative change.')
+    commands.add_parser('concurrency', help='Measure the read throughput of ConcurrentProperties under concurrent readers.')
+    options = parser.parse_args(args)
+    if options.command == 'run':
+        results = runBenchmarks(options)
+        if options.output:
+            with open(options.output, 'w') as outFile:
+                json.dump({'python': sys.version, 'options': dict((name, getattr(options, name)) for name in
+                                                                 ('size', 'depth', 'references', 'continuations', 'repeat')),
+                           'results': results}, outFile, indent=2, sort_keys=True)
+    elif options.command == 'compare':
+        with open(options.baseline) as baselineFile, open(options.current) as currentFile:
+            baseline, current = json.load(baselineFile), json.load(currentFile)
+        if baseline['options'] != current['options']:
+            print 'Warning: the runs used different options %s and %s.' % (baseline['options'], current['options'])
+        regressions = compareResults(baseline['results'], current['results'], options.threshold)
+        for name, metric, before, after in regressions:
+            print 'REGRESSION %-20s %-12s %16d -> %d' % (name, metric, before, after)
+        if not regressions:
+            print 'No regressions.'
+        return 1 if regressions else 0
+    else:
+        benchmarkConcurrentReads()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
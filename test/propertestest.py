@@ -5,17 +5,101 @@ Created on Apr 28, 2013
 '''
 import unittest
 
-from reportlab.lib.validators import isCallable
 import io
 import StringIO
 import os
+import subprocess
 import sys
+import random
+import threading
+import time
 import properties as p
 from mock import patch
+from properties import ParseError
+
+IMPORT_TIME_BUDGET = 0.035  # Seconds the import of the properties module may take, see testImportTime.
 
 """
 TODO: Unittests for list and store.
 """
+def legacyLoad(inStream):
+    """
+    The original character by character parser of Properties.load, used as the reference for the conformance tests of the tokenizer. It
+    differs from the original in the handling of the line terminators only: '\\r\\n' and a '\\r' ending the stream no longer produce empty
+    lines, the original failed on them, and an empty line or a line comprising of whitespaces only ends the multiline property being
+    accumulated, as in java.util.Properties, whatever its terminators. The original only ended it on an empty line between two '\\r', and
+    joined the next line to the property otherwise.
+    """
+    def trailingBackSlashCount(s):
+        return len(s) - len(s.rstrip('\\'))
+
+    def getPropertyFromStringLine(s):
+        precedingBackSlash = False
+        key = value = ''
+        for i in range(len(s)):
+            if s[i] == '\\':
+                precedingBackSlash = not precedingBackSlash
+            elif s[i] in '=:' and not precedingBackSlash:
+                key = s[:i]
+                value = s[i+1:]
+                break
+            else:
+                precedingBackSlash = False
+        if key == '':
+            raise ParseError('Unable to parse property. Should conform to the property line rule.')
+        return (key.strip(), value.strip())
+
+    properties = {}
+    accLine = []
+    for lines in inStream:
+        if lines.endswith('\r\n'):
+            lines = lines[:-2] + '\n'
+        lines = lines.split('\r')
+        if not lines[-1]:   # The stream ends with '\r', no line follows it.
+            lines.pop()
+        for line in lines:
+            if line.startswith('#') or line.startswith('!') or (not line.strip() and not accLine):
+                continue
+            line = line.strip()
+            if trailingBackSlashCount(line) % 2 == 0:
+                accLine.append(line)
+                prop = getPropertyFromStringLine(''.join(accLine))
+                properties[prop[0]] = prop[1]
+                accLine = []
+            else:
+                accLine.append(line[:-1].strip())
+    if accLine != []:
+        raise ParseError('Invalid termination of stream, was expecting more.')
+    return properties
+
+def generatePropertiesCorpus(count, seed=0):
+    """
+    Generates :param count random property files mixing separators, escapes, comments, continuation lines and line terminators.
+    """
+    rand = random.Random(seed)
+    keyFragments = ['key', '.', '-', '\\t', '\\=', '\\:', '\\\\', '\\t', '\\ ']
+    valueFragments = keyFragments + ['value', ' ', '=', ':', '${key}', '#', '!']
+    corpus = []
+    for _ in range(count):
+        lines = []
+        for _ in range(rand.randint(0, 20)):
+            kind = rand.random()
+            if kind < 0.1:
+                lines.append(rand.choice(' #!') + ''.join(rand.choice(valueFragments) for _ in range(3)))
+            elif kind < 0.15:
+                lines.append(rand.choice(['', ' \t', '\f']))
+            else:
+                parts = ['k'] + [rand.choice(keyFragments) for _ in range(rand.randint(0, 3))] + [rand.choice(' =:'), rand.choice('=:')]
+                parts += [rand.choice(valueFragments) for _ in range(rand.randint(0, 6))]
+                line = ''
+                for part in parts:
+                    if rand.random() < 0.1:  # continuation line
+                        line += rand.choice(['\\', ' \\', '\\\\\\']) + rand.choice(['\n', '\r', '\r\n']) + rand.choice(['', ' ', '\t'])
+                    line += part
+                lines.append(line)
+        corpus.append(''.join(line + rand.choice(['\n', '\r\n', '\r']) for line in lines))
+    return corpus
+
 class PropertiesTest(unittest.TestCase):
 
     @staticmethod
@@ -28,7 +112,7 @@ class PropertiesTest(unittest.TestCase):
     
     @staticmethod
     def __getExceptionFromCall(func, *args, **kwargs):
-        if not isCallable(func):
+        if not callable(func):
             return RuntimeError('First argument must be callable.')
         try:
             func(*args, **kwargs)        
@@ -83,6 +167,44 @@ class PropertiesTest(unittest.TestCase):
         self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.setProperty, 'key', 1.3).__class__ == TypeError)
         self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.setProperty, 'key', prop).__class__ == TypeError)
            
+    def testGetPropertyDeepDefaultsChain(self):
+        layers = [p.Properties()]
+        for i in range(5):
+            layers.append(p.Properties(layers[-1]))
+        for i, layer in enumerate(layers):
+            layer.setProperty('key', 'value' + str(i))
+            layer.setProperty('key' + str(i), 'value' + str(i))
+        top = layers[-1]
+        self.assertEqual(top.getProperty('key'), 'value5')
+        self.assertEqual(top.getProperty('key0'), 'value0')
+        self.assertEqual(top.getProperty('key3'), 'value3')
+        self.assertEqual([layer._Properties__index for layer in layers[:4]], [None] * 4)   # Only the queried defaults hold an index.
+        index = layers[4]._Properties__index
+        layers[0].setProperty('key0', 'value0-updated')
+        layers[0].setProperty('key6', 'value6')
+        self.assertEqual(top.getProperty('key0'), 'value0-updated')
+        self.assertEqual(top.getProperty('key6'), 'value6')
+        layers[3].setProperty('key', 'value3-updated')
+        layers[4].setProperty('key1', 'value1-4')
+        self.assertEqual(layers[4].getProperty('key'), 'value4')
+        self.assertEqual(top.getProperty('key1'), 'value1-4')
+        layers[1].setProperty('ns.a', 'a')
+        self.assertEqual(layers[4].getNamespaceProperties('ns'), {'ns.a': 'a'})
+        layers[0].setProperty('ns.b', 'b')
+        layers[2].setProperty('ns.a', 'a2')
+        self.assertEqual(layers[4].getNamespaceProperties('ns'), {'ns.a': 'a2', 'ns.b': 'b'})
+        self.assertTrue(layers[4]._Properties__index is index)    # Updated key by key rather than rebuilt.
+        self.assertEqual([layer._Properties__index for layer in layers[:4]], [None] * 4)
+        layers[2].properties = {'key0': 'value0-replaced'}
+        self.assertEqual(top.getProperty('key0'), 'value0-replaced')
+        self.assertEqual(top.getProperty('key2'), None)
+        layers[3].defaults = None
+        self.assertEqual(top.getProperty('key0'), None)
+        self.assertEqual(top.getAllProps(), {'key': 'value5', 'key1': 'value1-4', 'key3': 'value3', 'key4': 'value4', 'key5': 'value5'})
+        allProps = top.getAllProps()
+        allProps['key'] = 'changed'
+        self.assertEqual(top.getProperty('key'), 'value5')
+
     def testGetPropertyExpandedBehavesLikeGetProperty(self):
         prop = p.Properties()
         self.assertEqual(prop.getExpandedProperty('key'), None)
@@ -111,6 +233,137 @@ class PropertiesTest(unittest.TestCase):
         self.assertEqual(prop1.getExpandedProperty('key22'), 'value22 value2 value1')
         self.assertEqual(prop1.getExpandedProperty('key23'), 'value23 value22 value2 value1 value1 ${not-found-ref}')    
             
+    def testGetPropertyExpandedInvalidation(self):
+        prop = p.Properties()
+        prop.setProperty('key1', 'value1')
+        prop.setProperty('key2', '${key1}-2')
+        prop.setProperty('key3', '${key2}-3 ${key4}')
+        self.assertEqual(prop.getExpandedProperty('key3'), 'value1-2-3 ${key4}')
+        prop.setProperty('key1', 'value1-updated')
+        self.assertEqual(prop.getExpandedProperty('key3'), 'value1-updated-2-3 ${key4}')
+        prop.setProperty('key4', 'value4')
+        self.assertEqual(prop.getExpandedProperty('key3'), 'value1-updated-2-3 value4')
+        prop1 = p.Properties(prop)
+        prop1.setProperty('key5', '${key2}')
+        self.assertEqual(prop1.getExpandedProperty('key5'), 'value1-updated-2')
+        prop.setProperty('key1', 'value1')
+        self.assertEqual(prop1.getExpandedProperty('key5'), 'value1-2')
+        prop1.defaults = p.Properties()
+        self.assertEqual(prop1.getExpandedProperty('key5'), '${key2}')
+        prop.properties = {'key1': 'value1-replaced', 'key2': '${key1}'}
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-replaced')
+
+    def testDirectMutation(self):
+        base = p.Properties()
+        base.setProperty('key1', 'value1')
+        prop = p.Properties(base)
+        prop.setProperty('key2', '${key1}-2')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-2')
+        base.properties['key1'] = 'value1-changed'
+        base.properties['key3'] = 'value3'
+        self.assertEqual(prop.getProperty('key3'), 'value3')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-changed-2')
+        del base.properties['key3']
+        self.assertEqual(prop.getAllProps(), {'key1': 'value1-changed', 'key2': '${key1}-2'})
+        prop.properties.update(key2='${key1}-updated')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-changed-updated')
+        values = {'key1': 'value1'}
+        base.properties = values
+        values['key1'] = 'value1-copied'
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-updated')
+        statistics = p.Properties.enableStatistics()
+        try:
+            prop.setProperty('key4', 'value4')
+            self.assertEqual(prop.getExpandedProperty('key2'), 'value1-updated')
+        finally:
+            p.Properties.disableStatistics()
+        self.assertEqual(statistics.expansionHits, 1)
+
+    def testGetPropertyExpandedSpecialCharacters(self):
+        prop = p.Properties()
+        prop.setProperty('a.b*', 'value\\1')
+        prop.setProperty('key', '${a.b*} ${a.b*}')
+        self.assertEqual(prop.getExpandedProperty('key'), 'value\\1 value\\1')
+        self.assertEqual(prop.getExpandedProperty('not-found', '${a.b*}'), 'value\\1')
+
+    def testGetPropertyExpandedCyclicReference(self):
+        prop = p.Properties()
+        prop.setProperty('key1', 'value1 ${key2}')
+        prop.setProperty('key2', 'value2 ${key3}')
+        prop.setProperty('key3', 'value3 ${key1}')
+        e = PropertiesTest.__getExceptionFromCall(prop.getExpandedProperty, 'key1')
+        self.assertTrue(e.__class__ == p.CyclicReferenceError)
+        self.assertEqual(e.cycle, ['key1', 'key2', 'key3', 'key1'])
+        prop.setProperty('key3', 'value3')
+        self.assertEqual(prop.getExpandedProperty('key1'), 'value1 value2 value3')
+        prop.setProperty('key4', '${key4}')
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.getExpandedProperty, 'key4').__class__ == p.CyclicReferenceError)
+
+    def testExpandAll(self):
+        defaults = p.Properties()
+        defaults.setProperty('key1', 'value1')
+        defaults.setProperty('key2', '${key1}-2 ${key3}')
+        defaults.properties['key5'] = ''
+        prop = p.Properties(defaults)
+        prop.setProperty('key3', 'value3')
+        prop.setProperty('key4', '${key2}-4 ${key2} ${key5} ${not-found-ref}')
+        expected = {'key1': 'value1', 'key2': 'value1-2 value3', 'key3': 'value3', 'key4': 'value1-2 value3-4 value1-2 value3 ${key5} ${not-found-ref}',
+                    'key5': ''}
+        self.assertEqual(prop.expandAll(), expected)
+        for key in ('key1', 'key2', 'key3', 'key4'):
+            self.assertEqual(prop.getExpandedProperty(key), expected[key])
+        merged = prop.expandAll(asProperties=True)
+        self.assertEqual(merged.properties, expected)
+        self.assertEqual(merged.defaults, None)
+        e = PropertiesTest.__getExceptionFromCall(prop.expandAll, strict=True)
+        self.assertTrue(e.__class__ == p.UnresolvedReferenceError)
+        self.assertEqual(e.cycles, [])
+        self.assertEqual(e.dangling, [('key4', 'not-found-ref')])
+        prop.setProperty('key1', '${key4}')
+        prop.setProperty('key6', '${key6}')
+        prop.setProperty('key7', '${key3}-7')
+        e = PropertiesTest.__getExceptionFromCall(prop.expandAll)
+        self.assertTrue(e.__class__ == p.UnresolvedReferenceError)
+        self.assertEqual(sorted(sorted(set(cycle)) for cycle in e.cycles), [['key1', 'key2', 'key4'], ['key6']])
+        self.assertEqual(e.dangling, [])
+        self.assertEqual(prop.getExpandedProperty('key7'), 'value3-7')
+
+    def testExpandAllDeepReferences(self):
+        prop = p.Properties()
+        prop.setProperty('key0', 'value')
+        for i in range(1, 5000):
+            prop.setProperty('key%d' % i, '${key%d}' % (i - 1))
+        self.assertEqual(prop.expandAll()['key4999'], 'value')
+        self.assertEqual(prop.getExpandedProperty('key4999'), 'value')
+
+    def testGetNamespaceProperties(self):
+        defaults = p.Properties()
+        defaults.setProperty('db.primary.host', 'localhost')
+        defaults.setProperty('db.primary.port', '5432')
+        defaults.setProperty('db.secondary.host', 'remotehost')
+        prop = p.Properties(defaults)
+        prop.setProperty('db.primary.url', '${db.primary.host}:${db.primary.port}')
+        prop.setProperty('db.primaryX', 'value')
+        prop.setProperty('dc', 'value')
+        self.assertEqual(prop.getNamespaceProperties('db.primary'),
+                         {'db.primary.host': 'localhost', 'db.primary.port': '5432', 'db.primary.url': '${db.primary.host}:${db.primary.port}'})
+        self.assertEqual(prop.getNamespaceProperties('db.primary.', expanded=True, stripNamespace=True),
+                         {'host': 'localhost', 'port': '5432', 'url': 'localhost:5432'})
+        self.assertEqual(sorted(prop.getNamespaceProperties('db', stripNamespace=True)),
+                         ['primary.host', 'primary.port', 'primary.url', 'primaryX', 'secondary.host'])
+        self.assertEqual(prop.getNamespaceProperties(''), prop.getAllProps())
+        self.assertEqual(prop.getNamespaceProperties('not-found'), {})
+        prop.setProperty('db.primary.user', 'user')
+        defaults.setProperty('db.primary.password', 'secret')
+        self.assertEqual(sorted(prop.getNamespaceProperties('db.primary', stripNamespace=True)), ['host', 'password', 'port', 'url', 'user'])
+        self.assertEqual(sorted(defaults.getNamespaceProperties('db.primary', stripNamespace=True)), ['host', 'password', 'port'])
+        defaults.setProperty('db.primary.name', 'name')
+        self.assertEqual(sorted(defaults.getNamespaceProperties('db.primary', stripNamespace=True)), ['host', 'name', 'password', 'port'])
+        defaults.load(PropertiesTest.getInputStream(''.join('db.replica.host%d=host%d\n' % (i, i) for i in range(200))))
+        self.assertEqual(len(defaults.getNamespaceProperties('db.replica')), 200)
+        self.assertEqual(defaults.getNamespaceProperties('db.replica', stripNamespace=True)['host199'], 'host199')
+        self.assertEqual(sorted(defaults.getNamespaceProperties('db', stripNamespace=True))[:3], ['primary.host', 'primary.name', 'primary.password'])
+
     def testGetPropertyLoadSingleLinePropertiesSimple(self):
         prop = p.Properties()
         inputString = 'key1=value1\nkey2=value2 \n key3 = value3 \r\n \tkey4\t=\f \t value4 \t\n key5 = "  value5\t"'        
@@ -150,6 +403,103 @@ class PropertiesTest(unittest.TestCase):
         self.assertEqual(prop.getProperty('key3\\\\'), 'value3\\\\\\\\')
         self.assertEqual(prop.getProperty('key4\:--'), 'value4')
           
+    def testLoadConformance(self):
+        corpus = generatePropertiesCorpus(500)
+        corpus.append('key1\\\n= value1 \n key\\\n2\\\n=\\\r\n\t value2\t\rkey3\\\\=value3\\\\\\\\ \r key4\:-- = val \\\r\t\t ue \\\r 4  ')
+        corpus.append('a=x\\\r\rb=1\n')
+        corpus.append('a=x\\\r\n\r\nb=1\r\nc=\\\n \t\nd=\\\r\r')
+        corpus.append('key1=\nkey2==value2 \n key3\= = v=a:l:u=e:3 \r\n \tkey\t4=\f \t val\tu\te4 \t\n ke\=y\:\t\f5\t\f : "  value5\t"')
+        for inputString in corpus:
+            try:
+                expected = legacyLoad(PropertiesTest.getInputStream(inputString))
+            except ParseError:
+                expected = ParseError
+            for blockSize in (1, 3, 1 << 16):
+                prop = p.Properties()
+                with patch('properties._BLOCK_SIZE', blockSize):
+                    e = PropertiesTest.__getExceptionFromCall(prop.load, PropertiesTest.getInputStream(inputString))
+                if expected is ParseError:
+                    self.assertTrue(e.__class__ == ParseError, repr(inputString))
+                else:
+                    self.assertEqual(prop.properties, expected, repr(inputString))
+        for inputString in ('a=x\\\r\rb=1\n', 'a=x\\\n\nb=1', 'a=x\\\r\n \t\r\nb=1\r\n'):
+            prop = p.Properties()
+            prop.load(PropertiesTest.getInputStream(inputString))
+            self.assertEqual(prop.properties, {'a': 'x', 'b': '1'}, repr(inputString))
+
+    def testLoadLineIterable(self):
+        prop = p.Properties()
+        prop.load(['key1=value1\n', 'key2=\\\n', '  value2\r\n', '#key3=value3'])
+        self.assertEqual(prop.properties, {'key1': 'value1', 'key2': 'value2'})
+
+    def testLoadUnescape(self):
+        prop = p.Properties()
+        inputString = 'ke\\=y\\:1 = va\\tl\\nue\\u00e9\\u0041\\\\1\nkey\\ 2\\#=\\!value2\n'
+        prop.load(PropertiesTest.getInputStream(inputString), unescape=True)
+        self.assertEqual(prop.properties, {'ke=y:1': u'va\tl\nue\xe9A\\1', 'key 2#': '!value2'})
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(
+            p.Properties().load, PropertiesTest.getInputStream('key=\\u00g1'), unescape=True).__class__ == ParseError)
+
+    def testIterParse(self):
+        inputString = '# comment\nkey1=value1\r\n\nkey2 = val\\\n  ue2\rkey3\\=:value3\n  \nkey4\\\n\\\n=value4'
+        entries = list(p.Properties.iterParse(PropertiesTest.getInputStream(inputString)))
+        self.assertEqual(entries, [('key1', 'value1', 2), ('key2', 'value2', 4), ('key3\\=', 'value3', 6), ('key4', 'value4', 8)])
+        with patch('properties._BLOCK_SIZE', 2):
+            self.assertEqual(list(p.Properties.iterParse(PropertiesTest.getInputStream(inputString))), entries)
+        entries = p.Properties.iterParse(PropertiesTest.getInputStream('key1=value1\nkey2=value2\n\n=value3\n'))
+        self.assertEqual(entries.next(), ('key1', 'value1', 1))
+        self.assertEqual(entries.next(), ('key2', 'value2', 2))
+        e = PropertiesTest.__getExceptionFromCall(entries.next)
+        self.assertTrue(e.__class__ == ParseError)
+        self.assertTrue('line 4' in str(e))
+
+    def testPropertiesParser(self):
+        inputString = '# comment\nkey1=value1\r\n\nkey2 = val\\\n  ue2\rkey3\\=:value3\n  \nkey4\\\n\\\n=value4'
+        expected = list(p.Properties.iterParse(PropertiesTest.getInputStream(inputString)))
+        rand = random.Random(0)
+        for data in (inputString, unicode(inputString)) * 20:
+            parser = p.PropertiesParser()
+            entries = []
+            i = 0
+            while i < len(data):
+                size = rand.randint(0, 5)
+                entries.extend(parser.feed(data[i:i + size]))
+                i += size
+            entries.extend(parser.close())
+            self.assertEqual(entries, expected)
+            self.assertEqual(parser.lineNumber, 10)
+        parser = p.PropertiesParser()
+        self.assertEqual(parser.feed(u'a=1\r') + parser.feed(u'\nb=2\n'), [(u'a', u'1', 1), (u'b', u'2', 2)])
+        with patch('properties._BLOCK_SIZE', 4):
+            self.assertEqual([line for _, _, line in p.Properties.iterParse(io.StringIO(u'a=1\r\nb=2\r\nc=3\n'))], [1, 2, 3])
+        merging = p.MergingPropertiesParser(2)
+        chunks = [['key1=low\nkey2=', 'low\nempty=\n'], [u'key2=high\nkey3=', u'h\xefgh']]
+        for i in (1, 0):    # The second source completes first.
+            for chunk in chunks[i]:
+                merging.feed(i, chunk)
+            if i:
+                merging.close(i)
+                self.assertTrue(PropertiesTest.__getExceptionFromCall(merging.merge).__class__ == ValueError)
+        merging.close(0)
+        merged = merging.merge()
+        self.assertEqual(merged.properties, {'key1': 'low', 'key2': 'high', 'key3': u'h\xefgh', 'empty': ''})
+        self.assertEqual(merged.getProperty('key3'), u'h\xefgh')
+        prop = p.Properties()
+        prop.setProperty('key1', 'value1')
+        prop.setProperty('key2', '${key1}-2')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-2')
+        parser = p.PropertiesParser()
+        prop.loadEntries(parser.feed(u'key1=caf\xe9\nkey3='))
+        prop.loadEntries(parser.close())
+        self.assertEqual(prop.getExpandedProperty('key2'), u'caf\xe9-2')
+        self.assertEqual(prop.getProperty('key3', 'default'), '')
+        parser = p.PropertiesParser()
+        self.assertEqual(parser.feed('key1=value1\n=value2\nkey3=value3\n'), [('key1', 'value1', 1)])
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(parser.feed, 'key4=value4\n').__class__ == ParseError)
+        parser = p.PropertiesParser(unescape=True)
+        self.assertEqual(parser.feed('key\\tone=multi\\\n'), [])
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(parser.close).__class__ == ParseError)
+
     def testCreatePropertyFromPropertiesFile(self):        
         inputString = 'key1\\\n= value1 \n key\\\n2\\\n=\\\r\n\t value2\t\rkey3\\\\=value3\\\\\\\\ \r key4\:-- = val \\\r\t\t ue \\\r 4  '
         f = open('tmp.properties', 'w')
@@ -162,6 +512,132 @@ class PropertiesTest(unittest.TestCase):
         self.assertEqual(prop.getProperty('key4\:--'), 'value4')
         os.remove('tmp.properties')
      
+    def testMappedProperties(self):
+        inputString = '# comment\r\nkey1=value1\nkey2 = val\\\r\n  ue2 ${key1}\rkey3\\=:value3\n\nkey1=value1-updated\nkey4 : ${key3\\=}'
+        f = open('tmp.properties', 'wb')
+        f.write(inputString)
+        f.close()
+        defaults = p.Properties()
+        defaults.setProperty('key5', 'value5')
+        prop = p.MappedProperties('tmp.properties', defaults)
+        self.assertEqual(len(prop.properties), 4)
+        self.assertEqual(sorted(prop.properties), ['key1', 'key2', 'key3\\=', 'key4'])     # The redefined key1 once.
+        self.assertEqual(prop.properties._MappedPropertyDict__values, {})     # Nothing parsed and kept in memory but the index.
+        self.assertTrue('key1' in prop.properties and 'key5' not in prop.properties)
+        self.assertEqual(prop.getProperty('key1'), 'value1-updated')
+        self.assertEqual(prop.getProperty('key3\\='), 'value3')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value2 value1-updated')
+        self.assertEqual(prop.getExpandedProperty('key4'), 'value3')
+        self.assertEqual(prop.getProperty('key5'), 'value5')
+        self.assertEqual(prop.getProperty('key6'), None)
+        self.assertEqual(prop.getAllProps(), dict(p.Properties.mergeProperties([prop]).properties))
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.setProperty, 'key', 'value').__class__ == TypeError)
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.load, PropertiesTest.getInputStream('key=value')).__class__ == TypeError)
+        child = p.Properties(prop)
+        child.setProperty('key6', '${key1} ${key5}')
+        self.assertEqual(child.getExpandedProperty('key6'), 'value1-updated value5')
+        prop.close()
+        with patch('properties.hash', lambda key: 7, create=True):    # All the keys collide, they are told apart by their parsed keys.
+            prop = p.MappedProperties('tmp.properties')
+            self.assertEqual(len(prop.properties), 4)
+            self.assertEqual(dict(prop.properties.iteritems()), dict(p.Properties.mergeProperties([prop]).properties))
+            self.assertEqual(prop.getProperty('key1'), 'value1-updated')
+            self.assertEqual(prop.getProperty('key6'), None)
+        prop.close()
+        open('tmp.properties', 'w').close()
+        prop = p.MappedProperties('tmp.properties')
+        self.assertEqual(prop.getAllProps(), {})
+        prop.close()
+        os.remove('tmp.properties')
+
+    def testCreatePropertyFromPropertiesFileSnapshot(self):
+        f = open('tmp.properties', 'w')
+        f.write('key1=value1\nkey2=${key1}-2\nkey3=${key2}-3\n')
+        f.close()
+        prop = p.Properties.createPropertiesFromPropertiesFile('tmp.properties', snapshotFile='tmp.snapshot')
+        self.assertTrue(os.path.exists('tmp.snapshot'))
+        with patch.object(p.Properties, 'load') as load:
+            prop = p.Properties.createPropertiesFromPropertiesFile('tmp.properties', snapshotFile='tmp.snapshot')
+            self.assertFalse(load.called)
+        self.assertEqual(prop.properties, {'key1': 'value1', 'key2': '${key1}-2', 'key3': '${key2}-3'})
+        self.assertEqual(prop.getExpandedProperty('key3'), 'value1-2-3')
+        prop.setProperty('key1', 'value1-updated')
+        self.assertEqual(prop.getExpandedProperty('key3'), 'value1-updated-2-3')
+        defaults = p.Properties()
+        defaults.setProperty('key4', 'value4')
+        prop = p.Properties.createPropertiesFromPropertiesFile('tmp.properties', defaults, snapshotFile='tmp.snapshot')
+        self.assertEqual(prop.getProperty('key4'), 'value4')
+        os.utime('tmp.properties', (1000000000, 1000000000))
+        p.Properties.createPropertiesFromPropertiesFile('tmp.properties', snapshotFile='tmp.snapshot')     # Stale, stored again.
+        f = open('tmp.properties', 'w')
+        f.write('key1=value9\nkey2=${key1}-2\nkey3=${key2}-3\n')
+        f.close()
+        os.utime('tmp.properties', (1000000000, 1000000000))    # Same size and modification time, as cp -p, tar, rsync -t.
+        prop = p.Properties.createPropertiesFromPropertiesFile('tmp.properties', snapshotFile='tmp.snapshot')
+        self.assertEqual(prop.getExpandedProperty('key3'), 'value9-2-3')
+        f = open('tmp.properties', 'w')
+        f.write('key1=value1-changed\n')
+        f.close()
+        os.utime('tmp.properties', (0, 0))
+        prop = p.Properties.createPropertiesFromPropertiesFile('tmp.properties', snapshotFile='tmp.snapshot')
+        self.assertEqual(prop.properties, {'key1': 'value1-changed'})
+        os.remove('tmp.properties')
+        os.remove('tmp.snapshot')
+
+    def testStoreAndLoadSnapshot(self):
+        defaults = p.Properties()
+        defaults.setProperty('key1', 'value1')
+        prop = p.Properties(defaults)
+        prop.setProperty('key2', '${key1}-2')
+        prop.setProperty('key3', '${key3}')
+        prop.storeSnapshot('tmp.snapshot')
+        loaded = p.Properties.loadSnapshot('tmp.snapshot')
+        self.assertEqual(loaded.properties, prop.properties)
+        self.assertEqual(loaded.defaults.properties, defaults.properties)
+        self.assertEqual(loaded.getExpandedProperty('key2'), 'value1-2')
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(loaded.getExpandedProperty, 'key3').__class__ == p.CyclicReferenceError)
+        self.assertEqual(p.Properties.loadSnapshot('tmp.snapshot', ['propertestest.py']), None)
+        f = open('tmp.snapshot', 'w')
+        f.write('not a snapshot')
+        f.close()
+        self.assertEqual(p.Properties.loadSnapshot('tmp.snapshot'), None)
+        os.remove('tmp.snapshot')
+        self.assertEqual(p.Properties.loadSnapshot('tmp.snapshot'), None)
+
+    def testReload(self):
+        f = open('tmp.properties', 'w')
+        f.write('key1=value1\nkey2=${key1}-2\nkey3=value3\nkey4=value4\nkey5=${key3}\n')
+        f.close()
+        prop = p.Properties.createPropertiesFromPropertiesFile('tmp.properties')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-2')
+        self.assertEqual(prop.getExpandedProperty('key5'), 'value3')
+        notifications = []
+        listener = lambda properties, diff: notifications.append((properties, diff))
+        prop.addListener(listener)
+        f = open('tmp.properties', 'w')
+        f.write('key1=value1-changed\nkey2=${key1}-2\nkey3=value3\nkey5=${key3}\nkey6=value6\n')
+        f.close()
+        diff = prop.reload()
+        self.assertEqual(diff, p.PropertiesDiff(frozenset(['key6']), frozenset(['key1']), frozenset(['key4'])))
+        self.assertEqual(notifications, [(prop, diff)])
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-changed-2')
+        self.assertEqual(prop.getProperty('key4'), None)
+        self.assertEqual(prop.getProperty('key6'), 'value6')
+        self.assertEqual(prop.reload(), p.PropertiesDiff(frozenset(), frozenset(), frozenset()))
+        self.assertEqual(len(notifications), 1)
+        prop.removeListener(listener)
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.reload, PropertiesTest.getInputStream('=value')).__class__ == ParseError)
+        self.assertEqual(prop.getProperty('key1'), 'value1-changed')
+        defaults = p.Properties()
+        defaults.setProperty('key1', 'value1-default')
+        prop = p.Properties(defaults)
+        prop.load(PropertiesTest.getInputStream('key1=value1\nkey2=${key1}'))
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1')
+        prop.reload(PropertiesTest.getInputStream('key2=${key1}'))
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-default')
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(p.Properties().reload).__class__ == ValueError)
+        os.remove('tmp.properties')
+
     def testCreatePropertyFromPropertiesFileExceptionFileNotFound(self):        
         self.assertTrue(PropertiesTest.__getExceptionFromCall(
             p.Properties.createPropertiesFromPropertiesFile, 'tmp.properties').__class__ == IOError)
@@ -176,6 +652,164 @@ class PropertiesTest(unittest.TestCase):
         prop.store(outStream)         
         self.assertEqual(outStream.getvalue(), 'key1=value1\nkey2=value2\nkey3\\\\=value3\\\\\\\\\nkey4\:--=value4\nkey5=value5\nkey6=value6\n')
     
+    def testLoadFromXML(self):
+        inputString = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE properties SYSTEM "http://java.sun.com/dtd/properties.dtd">
+<properties>
+<comment>Comment</comment>
+<entry key="key1">value1</entry>
+<entry key="key2">${key1} &amp; &lt;value2&gt;</entry>
+<entry key="key=3"></entry>
+<entry key="key4">caf\xc3\xa9</entry>
+<entry key="key1">value1-updated</entry>
+</properties>
+'''
+        prop = p.Properties()
+        prop.loadFromXML(PropertiesTest.getInputStream(inputString))
+        self.assertEqual(prop.properties, {'key1': 'value1-updated', 'key2': '${key1} & <value2>', 'key=3': '', 'key4': u'caf\xe9'})
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-updated & <value2>')
+        for inputString in ('<properties><entry key="key">value', '<props/>', '<properties><entry>value</entry></properties>',
+                            '<properties><entry key="key"><b/></entry></properties>'):
+            e = PropertiesTest.__getExceptionFromCall(p.Properties().loadFromXML, PropertiesTest.getInputStream(inputString))
+            self.assertTrue(e.__class__ == ParseError, inputString)
+
+    def testStoreToXML(self):
+        prop = p.Properties()
+        prop.properties = {'key1': 'value1', 'key2': '${key1} & <"value2">', 'key=3': '', 'key4': u'caf\xe9'}
+        out = io.BytesIO()
+        prop.storeToXML(out, comment='Comment & more')
+        self.assertEqual(out.getvalue(), '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE properties SYSTEM "http://java.sun.com/dtd/properties.dtd">
+<properties>
+<comment>Comment &amp; more</comment>
+<entry key="key1">value1</entry>
+<entry key="key2">${key1} &amp; &lt;"value2"&gt;</entry>
+<entry key="key4">caf\xc3\xa9</entry>
+<entry key="key=3"></entry>
+</properties>
+''')
+        loaded = p.Properties()
+        loaded.loadFromXML(io.BytesIO(out.getvalue()))
+        self.assertEqual(loaded.properties, prop.properties)
+        prop.properties = dict(('key%d' % i, 'value%d' % i) for i in range(3000))
+        out = io.StringIO()
+        prop.storeToXML(out, encoding='ISO-8859-1')
+        loaded = p.Properties()
+        loaded.loadFromXML(io.BytesIO(out.getvalue().encode('ISO-8859-1')))
+        self.assertEqual(loaded.properties, prop.properties)
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.storeToXML, '').__class__ == TypeError)
+        prop.properties = {'cl\xc3\xa9': 'caf\xc3\xa9 & cr\xc3\xa8me', 'key': u'caf\xe9'}
+        out = io.BytesIO()
+        prop.storeToXML(out, comment='R\xc3\xa9sum\xc3\xa9', encoding='ISO-8859-1')
+        self.assertTrue('<comment>R\xe9sum\xe9</comment>\n<entry key="cl\xe9">caf\xe9 &amp; cr\xe8me</entry>\n' in out.getvalue())
+        loaded = p.Properties()
+        loaded.loadFromXML(io.BytesIO(out.getvalue()))
+        self.assertEqual(loaded.properties, {u'cl\xe9': u'caf\xe9 & cr\xe8me', 'key': u'caf\xe9'})
+        prop.properties = {'key': 'caf\xe9'}
+        self.assertTrue(isinstance(PropertiesTest.__getExceptionFromCall(prop.storeToXML, io.BytesIO()), UnicodeDecodeError))
+
+    def testWritePropertiesOptions(self):
+        defaults = p.Properties()
+        defaults.setProperty('key0', 'value0')
+        prop = p.Properties(defaults)
+        prop.properties = dict(('key%d' % i, 'value%d' % i) for i in range(1, 3000))
+        out = PropertiesTest.getOutputStream()
+        prop.store(out, sort=False)
+        self.assertEqual(sorted(out.getvalue().splitlines()), sorted('key%d=value%d' % (i, i) for i in range(1, 3000)))
+        out = PropertiesTest.getOutputStream()
+        prop.store(out, includeDefaults=True)
+        self.assertTrue(out.getvalue().startswith('key0=value0\nkey1=value1\nkey10=value10\n'))
+        loaded = p.Properties()
+        loaded.load(PropertiesTest.getInputStream(str(out.getvalue())))
+        self.assertEqual(loaded.properties, prop.getAllProps())
+
+    def testWritePropertiesEscaped(self):
+        prop = p.Properties()
+        prop.properties = {'key=1': ' value1 ', 'key:2 ': 'val\tue\n2\\', '#key3': '!value3 \\', ' key4': u'caf\xe9\u20ac', 'key5': '${key1}  '}
+        out = io.StringIO()
+        prop.store(out, escape=True)
+        self.assertEqual(out.getvalue(), u'\\u0020key4=caf\\u00e9\\u20ac\n\\#key3=\\!value3 \\\\\nkey5=${key1} \\u0020\n'
+                         u'key\\:2\\u0020=val\\tue\\n2\\\\\nkey\\=1=\\u0020value1\\u0020\n')
+        loaded = p.Properties()
+        loaded.load(PropertiesTest.getInputStream(out.getvalue().encode('ascii')), unescape=True)
+        self.assertEqual(loaded.properties, prop.properties)
+        prop.properties = {'cl\xc3\xa9': ' caf\xc3\xa9\x01=', 'key': u'cr\xe8me', 'key2': 'value2'}
+        out = io.BytesIO()
+        prop.store(out, escape=True)
+        self.assertEqual(out.getvalue(), 'cl\xc3\xa9=\\u0020caf\xc3\xa9\\u0001\\=\nkey=cr\\u00e8me\nkey2=value2\n')
+        loaded = p.Properties()
+        loaded.load(io.BytesIO(out.getvalue()), unescape=True)
+        self.assertEqual(loaded.properties, prop.properties)
+        self.assertEqual(loaded.getProperty('cl\xc3\xa9').__class__, str)
+        out = io.StringIO()
+        prop.store(out)
+        self.assertEqual(out.getvalue(), u'cl\xe9= caf\xe9\x01=\nkey=cr\xe8me\nkey2=value2\n')
+
+    def testStoreToFile(self):
+        prop = p.Properties()
+        prop.setProperty('key=1', 'value1')
+        prop.setProperty('key2', 'value2')
+        prop.storeToFile('tmp.properties', escape=True)
+        self.assertEqual(open('tmp.properties').read(), 'key2=value2\nkey\\=1=value1\n')
+        os.chmod('tmp.properties', 0640)
+        prop.setProperty('key2', 'value2-updated')
+        prop.storeToFile('tmp.properties')
+        self.assertEqual(os.stat('tmp.properties').st_mode & 0777, 0640)
+        self.assertEqual(p.Properties.createPropertiesFromPropertiesFile('tmp.properties').getProperty('key2'), 'value2-updated')
+        prop.properties.update(('key%d' % i, 'value%d' % i) for i in range(3, 3000))
+        writers = [threading.Thread(target=prop.storeToFile, args=('tmp.properties',)) for _ in range(8)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        out = PropertiesTest.getOutputStream()
+        prop.store(out)
+        self.assertEqual(open('tmp.properties').read(), out.getvalue())
+        self.assertEqual([fName for fName in os.listdir('.') if fName.startswith('tmp.properties')], ['tmp.properties'])
+        with patch.object(p.Properties, 'store', side_effect=IOError('disk full')):
+            self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.storeToFile, 'tmp.properties').__class__ == IOError)
+        self.assertEqual([fName for fName in os.listdir('.') if fName.startswith('tmp.properties')], ['tmp.properties'])
+        self.assertEqual(p.Properties.createPropertiesFromPropertiesFile('tmp.properties').getProperty('key2'), 'value2-updated')
+        os.remove('tmp.properties')
+
+    def testPublishSharedProperties(self):
+        defaults = p.Properties()
+        defaults.load(PropertiesTest.getInputStream('host=localhost\nport=80\ncycle1=${cycle2}\ncycle2=${cycle1}'))
+        prop = p.Properties(defaults)
+        prop.load(PropertiesTest.getInputStream('url=http://${host}:${port}/${missing}\nport=8080\nempty=\nportRef=${port}'))
+        prop.load(io.StringIO(u'cl\xe9=caf\xe9'))
+        for expanded in (False, True):
+            prop.publish('tmp.shared', expanded)
+            shared = p.SharedProperties('tmp.shared')
+            try:
+                self.assertEqual(shared.getAllProps(), prop.getAllProps())
+                self.assertEqual(sorted(shared.properties), sorted(prop.getAllProps()))
+                self.assertEqual(len(shared.properties), 8)
+                self.assertEqual(shared.getProperty('port'), '8080')
+                self.assertEqual(shared.getProperty(u'cl\xe9'), u'caf\xe9')
+                self.assertEqual(shared.getProperty('missing', 'default'), 'default')
+                self.assertEqual(shared.getExpandedProperty('url'), 'http://localhost:8080/${missing}')
+                self.assertEqual(shared.getExpandedProperty('url', formatter=len), len('http://localhost:8080/${missing}'))
+                self.assertEqual(shared.getExpandedProperty('missing', 'default'), 'default')
+                self.assertTrue(PropertiesTest.__getExceptionFromCall(shared.getExpandedProperty, 'cycle1').__class__ == p.CyclicReferenceError)
+                self.assertTrue(PropertiesTest.__getExceptionFromCall(shared.setProperty, 'key', 'value').__class__ == TypeError)
+                self.assertEqual(shared.properties.getExpanded('url') is not None, expanded)
+                self.assertEqual(dict(shared.properties.items()), prop.getAllProps())
+                self.assertTrue(PropertiesTest.__getExceptionFromCall(shared.properties.update, {}).__class__ == TypeError)
+                statistics = p.Properties.enableStatistics()
+                try:
+                    self.assertEqual(shared.getInt('portRef'), 8080)
+                finally:
+                    p.Properties.disableStatistics()
+                self.assertEqual(statistics.expansions, 0 if expanded else 2)
+            finally:
+                shared.close()
+        self.assertEqual([fName for fName in os.listdir('.') if fName.startswith('tmp.shared')], ['tmp.shared'])
+        with open('tmp.shared', 'w') as sharedFile:
+            sharedFile.write('key=value\n')
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(p.SharedProperties, 'tmp.shared').__class__ == ValueError)
+        os.remove('tmp.shared')
+
     def testWritePropertiesToStreamNoStream(self):
         prop = p.Properties()
         inputString = 'key1\\\n= value1 \n key\\\n2\\\n=\\\r\n\t value2\t\rkey3\\\\=value3\\\\\\\\ \r key4\:-- = val \\\r\t\t ue \\\r 4  '           
@@ -225,6 +859,242 @@ class PropertiesTest(unittest.TestCase):
         self.assertEqual(mergedProperties.properties, {'key': 'value', 'key1': 'value1'})
         self.assertEqual(mergedProperties.defaults, None)
     
+    def testMergedProperties(self):
+        base = p.Properties()
+        base.load(PropertiesTest.getInputStream('host=localhost\nport=80\nurl=http://${host}:${port}/${path}\nempty='))
+        layer = p.Properties(base)
+        layer.load(PropertiesTest.getInputStream('port=8080\npath=app'))
+        override = p.Properties()
+        override.load(PropertiesTest.getInputStream('host=example.org\nempty=value'))
+        for indexed in (False, True):
+            view = p.MergedProperties([layer, override], indexed)
+            merged = p.Properties.mergeProperties([layer, override]).properties
+            self.assertEqual(merged, {'host': 'example.org', 'port': '8080', 'url': 'http://${host}:${port}/${path}', 'path': 'app', 'empty': 'value'})
+            self.assertEqual(dict(view.properties.items()), merged)
+            self.assertEqual(view.getAllProps(), merged)
+            self.assertEqual(view.getProperty('port'), '8080')
+            self.assertEqual(view.getExpandedProperty('url'), 'http://example.org:8080/app')
+            base.setProperty('path', 'base')
+            layer.setProperty('port', '8443')
+            self.assertEqual(view.getExpandedProperty('url'), 'http://example.org:8443/app')
+            layer.properties = {'path': 'replaced'}
+            self.assertEqual(view.getExpandedProperty('url'), 'http://example.org:80/replaced')
+            child = p.Properties(view)
+            child.setProperty('key', '${host}')
+            self.assertEqual(child.getExpandedProperty('key'), 'example.org')
+            override.setProperty('host', 'example.com')
+            self.assertEqual(child.getExpandedProperty('key'), 'example.com')
+            materialized = view.materialize()
+            self.assertEqual(materialized.getAllProps(), view.getAllProps())
+            override.setProperty('host', 'example.org')
+            self.assertEqual(materialized.getProperty('host'), 'example.com')
+            self.assertTrue(PropertiesTest.__getExceptionFromCall(view.setProperty, 'key', 'value').__class__ == TypeError)
+            self.assertTrue(PropertiesTest.__getExceptionFromCall(view.loadEntries, [('key', 'value', 1)]).__class__ == TypeError)
+            layer.properties = {'port': '8080', 'path': 'app'}
+            del base.properties['path']
+        self.assertEqual(p.MergedProperties([]).getAllProps(), {})
+
+    def testMergePropertiesFiles(self):
+        fNames = []
+        for i in range(4):
+            fNames.append('tmp%d.properties' % i)
+            f = open(fNames[-1], 'w')
+            f.write('key=value%d\nkey%d=value%d\n' % (i, i, i))
+            f.close()
+        expected = p.Properties.mergeProperties([p.Properties.createPropertiesFromPropertiesFile(fName) for fName in fNames]).properties
+        self.assertEqual(expected['key'], 'value3')
+        for useThreads in (False, True):
+            mergedProperties = p.Properties.mergePropertiesFiles(fNames, processes=2, useThreads=useThreads)
+            self.assertEqual(mergedProperties.properties, expected)
+            self.assertEqual(mergedProperties.defaults, None)
+        self.assertEqual(p.Properties.mergePropertiesFiles(reversed(fNames)).getProperty('key'), 'value0')
+        self.assertEqual(p.Properties.mergePropertiesFiles([]).properties, {})
+        with patch('multiprocessing.cpu_count', return_value=1), patch('multiprocessing.pool.Pool') as pool:   # Loaded without any pool.
+            self.assertEqual(p.Properties.mergePropertiesFiles(fNames).properties, expected)
+            self.assertFalse(pool.called)
+        for fName in fNames:
+            os.remove(fName)
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(p.Properties.mergePropertiesFiles, fNames, 2).__class__ == IOError)
+
+    def testConcurrentProperties(self):
+        defaults = p.Properties()
+        defaults.setProperty('key0', 'value0')
+        prop = p.ConcurrentProperties(defaults)
+        prop.setProperty('key1', 'value1')
+        prop.load(PropertiesTest.getInputStream('key2=${key1}-${key0}'))
+        snapshot = prop.snapshot()
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-value0')
+        self.assertEqual(prop.getAllProps(), {'key0': 'value0', 'key1': 'value1', 'key2': '${key1}-${key0}'})
+        prop.setProperty('key1', 'value1-updated')
+        self.assertEqual(prop.getExpandedProperty('key2'), 'value1-updated-value0')
+        self.assertEqual(snapshot.getExpandedProperty('key2'), 'value1-value0')
+        self.assertTrue(prop.snapshot() is not snapshot)
+        child = p.Properties(prop)
+        child.setProperty('key3', '${key1}')
+        self.assertEqual(child.getExpandedProperty('key3'), 'value1-updated')
+        prop.setProperty('key1', 'value1')
+        self.assertEqual(child.getExpandedProperty('key3'), 'value1')
+        setProperty = p.Properties.setProperty
+        def setPropertyAndRead(properties, key, value):
+            setProperty(properties, key, value)
+            child.getExpandedProperty('key3')   # Read while the changed snapshot is not published yet.
+        with patch.object(p.Properties, 'setProperty', setPropertyAndRead):
+            prop.setProperty('key1', 'value1-published')
+        self.assertEqual(child.getExpandedProperty('key3'), 'value1-published')
+        prop.setProperty('key1', 'value1')
+        notifications = []
+        prop.addListener(lambda properties, diff: notifications.append((properties, diff)))
+        diff = prop.reload(PropertiesTest.getInputStream('key1=value1\nkey4=value4'))
+        self.assertEqual(diff, p.PropertiesDiff(frozenset(['key4']), frozenset(), frozenset(['key2'])))
+        self.assertEqual(notifications, [(prop, diff)])
+        prop.defaults = None
+        self.assertEqual(prop.getProperty('key0'), None)
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.setProperty, 'key', None).__class__ == TypeError)
+        self.assertEqual(p.ConcurrentProperties.fromProperties(defaults).getProperty('key0'), 'value0')
+
+    def testConcurrentPropertiesConsistentReads(self):
+        prop = p.ConcurrentProperties()
+        prop.load(PropertiesTest.getInputStream('key1=0\nkey2=0\nkey3=${key1}-${key2}'))
+        done = []
+        inconsistent = []
+        def read():
+            while not done:
+                snapshot = prop.snapshot()
+                key1, key2 = snapshot.getProperty('key1'), snapshot.getProperty('key2')
+                if key1 != key2 or snapshot.getExpandedProperty('key3') != key1 + '-' + key2:
+                    inconsistent.append((key1, key2))
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(1, 300):
+            prop.load(PropertiesTest.getInputStream('key1=%d\nkey2=%d' % (i, i)))
+        done.append(True)
+        for reader in readers:
+            reader.join()
+        self.assertEqual(inconsistent, [])
+        self.assertEqual(prop.getExpandedProperty('key3'), '299-299')
+
+    def testConcurrentPropertiesConcurrentExpansion(self):
+        defaults = p.ConcurrentProperties()
+        defaults.setProperty('other', '0')
+        prop = p.ConcurrentProperties(defaults)
+        errors = []
+        statistics = p.Properties.enableStatistics()
+        statistics.addHook('expansion', lambda key, depth, hit: time.sleep(0))     # Switches the threads in the middle of the expansions.
+        try:
+            for i in range(20):
+                prop.load(PropertiesTest.getInputStream('key0=%d\n' % i + ''.join('key%d=${key%d}-%d\n' % (j, j - 1, j) for j in range(1, 20))))
+                snapshot = prop.snapshot()  # Freshly published, nothing expanded yet.
+                self.assertTrue(snapshot._Properties__expanded is not None)     # The caches are allocated before the snapshot is published.
+                expected = dict(('key%d' % j, '-'.join([str(i)] + [str(k) for k in range(1, j + 1)])) for j in range(20))
+                def expand():
+                    try:
+                        for key in expected:
+                            if snapshot.getExpandedProperty(key) != expected[key]:
+                                errors.append(key)
+                    except Exception, e:
+                        errors.append(e)
+                readers = [threading.Thread(target=expand) for _ in range(4)]
+                for reader in readers:
+                    reader.start()
+                for reader in readers:
+                    reader.join()
+        finally:
+            p.Properties.disableStatistics()
+        self.assertEqual(errors, [])
+        interleaved = []
+        def interleave(key, depth, hit):    # Another reader drops the caches between the lookup and the read of a cached expansion.
+            if hit and not interleaved:
+                interleaved.append(key)
+                defaults.setProperty('other', '1')
+                snapshot.getExpandedProperty('key0')
+        statistics = p.Properties.enableStatistics()
+        statistics.addHook('expansion', interleave)
+        try:
+            self.assertEqual(snapshot.getExpandedProperty('key19'), expected['key19'])
+        finally:
+            p.Properties.disableStatistics()
+        self.assertEqual(interleaved, ['key19'])
+
+    def testOverlayProperties(self):
+        shared = p.Properties()
+        shared.load(PropertiesTest.getInputStream('host=localhost\nport=80\nurl=http://${host}:${port}'))
+        tenant = p.OverlayProperties(shared, {'port': '8080'})
+        other = p.OverlayProperties(shared)
+        self.assertEqual(tenant.getProperty('port'), '8080')
+        self.assertEqual(tenant.getProperty('host'), 'localhost')
+        self.assertEqual(tenant.getExpandedProperty('url'), 'http://localhost:8080')
+        self.assertEqual(other.getExpandedProperty('url'), 'http://localhost:80')
+        tenant.setProperty('host', 'tenant')
+        tenant.load(PropertiesTest.getInputStream('path=/tenant\nport=8443'))
+        self.assertEqual(tenant.getExpandedProperty('url'), 'http://tenant:8443')
+        self.assertEqual(sorted(tenant.properties), ['host', 'path', 'port'])
+        shared.setProperty('port', '81')
+        self.assertEqual(other.getExpandedProperty('url'), 'http://localhost:81')
+        self.assertEqual(tenant.getAllProps(), {'host': 'tenant', 'port': '8443', 'path': '/tenant', 'url': 'http://${host}:${port}'})
+        tenant.reload(PropertiesTest.getInputStream('port=8443'))
+        self.assertEqual(tenant.getExpandedProperty('url'), 'http://localhost:8443')
+        copy = tenant.copy()
+        copy.setProperty('port', '9000')
+        self.assertEqual(tenant.getProperty('port'), '8443')
+        self.assertEqual(copy.getExpandedProperty('url'), 'http://localhost:9000')
+        self.assertEqual(p.Properties.mergeProperties([tenant]).properties, {'host': 'localhost', 'port': '8443', 'url': 'http://${host}:${port}'})
+        shared.load(PropertiesTest.getInputStream('db.host=dbhost\ndb.port=5432\ndb.user=admin'))
+        tenant.load(PropertiesTest.getInputStream('db.user=tenant\ndb.name=tenantdb'))
+        self.assertEqual(tenant.getNamespaceProperties('db', stripNamespace=True),
+                         {'host': 'dbhost', 'port': '5432', 'user': 'tenant', 'name': 'tenantdb'})
+        self.assertEqual(p.MergedProperties([tenant], indexed=True).getAllProps(), tenant.getAllProps())
+        self.assertEqual(other.getNamespaceProperties('db', stripNamespace=True), {'host': 'dbhost', 'port': '5432', 'user': 'admin'})
+        self.assertEqual(tenant.expandAll()['url'], 'http://localhost:8443')
+        self.assertEqual(len(tenant.getAllProps()), 7)
+        tenant.properties['port'] = '9443'
+        self.assertEqual(tenant.getExpandedProperty('url'), 'http://localhost:9443')
+        del tenant.properties['port']
+        self.assertEqual(tenant.getExpandedProperty('url'), 'http://localhost:81')
+        for overlay in (tenant, other):     # The overlays do not copy the index of the shared properties.
+            self.assertFalse(isinstance(overlay._Properties__index, dict))
+            self.assertEqual(overlay._Properties__sortedKeys, None)
+
+    def testCompactProperties(self):
+        prop = p.Properties()
+        self.assertFalse(hasattr(prop, '__dict__'))
+        prop.setProperty(''.join(['key', '1']), 'value1')
+        prop.load(PropertiesTest.getInputStream('key2=value2'))
+        for key in prop.properties:
+            self.assertTrue(key is intern(key))
+        self.assertEqual(prop.getExpandedProperty('key1'), 'value1')
+
+    def testStatistics(self):
+        defaults = p.Properties()
+        defaults.load(PropertiesTest.getInputStream('port=80\nhost=localhost'))
+        prop = p.Properties(p.Properties(defaults))
+        prop.setProperty('url', 'http://${host}:${port}')
+        events = []
+        statistics = p.Properties.enableStatistics()
+        try:
+            self.assertTrue(p.Properties.getStatistics() is statistics)
+            statistics.addHook('lookup', lambda key, depth: events.append((key, depth)))
+            self.assertEqual(prop.getProperty('port'), '80')
+            self.assertEqual(prop.getProperty('missing'), None)
+            self.assertEqual(prop.getExpandedProperty('url'), 'http://localhost:80')
+            self.assertEqual(prop.getExpandedProperty('url'), 'http://localhost:80')
+            self.assertEqual(prop.getInt('port'), 80)
+            self.assertEqual(prop.getInt('port'), 80)
+            prop.load(PropertiesTest.getInputStream('key1=value1\n\nkey2=value2\n'))
+        finally:
+            self.assertTrue(p.Properties.disableStatistics() is statistics)
+        self.assertEqual(events[:2], [('port', 2), ('missing', None)])
+        stats = statistics.getStatistics()
+        self.assertEqual((stats['lookups'], stats['misses'], stats['chainDepths']), (5, 1, {0: 1, 2: 3}))
+        self.assertEqual((stats['expansions'], stats['expansionHits'], stats['nestedExpansions'], stats['maxExpansionDepth']), (5, 2, 2, 1))
+        self.assertEqual((stats['conversions'], stats['conversionHits'], stats['conversionHitRate']), (2, 1, 0.5))
+        self.assertEqual((stats['parses'], stats['parsedLines']), (1, 3))
+        prop.getProperty('port')
+        self.assertEqual(statistics.lookups, 5)
+        statistics.reset()
+        self.assertEqual(statistics.getStatistics()['expansions'], 0)
+        self.assertTrue(PropertiesTest.__getExceptionFromCall(statistics.addHook, 'unknown', len).__class__ == ValueError)
+
     def testFormattedProperty(self):
         prop = p.Properties()
         prop.setProperty('key', 'value')        
@@ -235,6 +1105,44 @@ class PropertiesTest(unittest.TestCase):
         prop.setProperty('key3', 'value2,${key2}')
         self.assertEqual(prop.getExpandedProperty('key3',  formatter = lambda s: map(lambda x: x.strip(), s.split(','))), ['value2','value1','value2','value3'])
             
+    def testTypedProperties(self):
+        prop = p.Properties()
+        prop.setProperty('int', '${base}2')
+        prop.setProperty('base', '4')
+        prop.setProperty('float', ' 2.5 ')
+        prop.setProperty('bool', 'Yes')
+        prop.setProperty('list', 'a, b ,${base}')
+        prop.setProperty('duration', '1h 30m 1.5s 250ms')
+        prop.setProperty('size', '1.5 KiB')
+        prop.setProperty('invalid', 'value')
+        self.assertEqual(prop.getInt('int'), 42)
+        self.assertEqual(prop.getFloat('float'), 2.5)
+        self.assertEqual(prop.getBoolean('bool'), True)
+        self.assertEqual(prop.getList('list'), ['a', 'b', '4'])
+        prop.getList('list').append('c')
+        self.assertEqual(prop.getList('list'), ['a', 'b', '4'])
+        self.assertEqual(prop.getList('list', separator='b'), ['a,', ',4'])
+        self.assertEqual(prop.getDuration('duration'), 5401.75)
+        self.assertEqual(prop.getSize('size'), 1536)
+        self.assertEqual(prop.getInt('not-found'), None)
+        self.assertEqual(prop.getInt('not-found', 7), 7)
+        prop.setProperty('base', '5')
+        self.assertEqual(prop.getInt('int'), 52)
+        self.assertEqual(prop.getList('list'), ['a', 'b', '5'])
+        with patch('__builtin__.int', side_effect=ValueError('invalid literal')) as int_:
+            for i in range(3):
+                self.assertTrue(PropertiesTest.__getExceptionFromCall(prop.getInt, 'invalid').__class__ == ValueError)
+            self.assertEqual(int_.call_count, 1)
+        for getter in (prop.getFloat, prop.getBoolean, prop.getDuration, prop.getSize):
+            self.assertTrue(PropertiesTest.__getExceptionFromCall(getter, 'invalid').__class__ == ValueError)
+        prop.setProperty('invalid', '0')
+        self.assertEqual(prop.getBoolean('invalid'), False)
+        self.assertEqual(prop.getInt('invalid'), 0)
+        self.assertEqual(prop.getSize('invalid'), 0)
+        self.assertEqual(prop.getDuration('invalid'), 0)
+        prop.setProperty('empty', ' ')
+        self.assertEqual(prop.getList('empty'), [])
+
     def testList(self):
         prop = p.Properties()
         out = StringIO.StringIO()
@@ -269,6 +1177,34 @@ class PropertiesTest(unittest.TestCase):
         out = StringIO.StringIO()
         prop1.store(out=out)
         self.assertEqual(out.getvalue(), 'key1=value1\nkey2=value2\n')
-    
+
+    def testExceptionHierarchy(self):
+        for error in (ParseError, p.CyclicReferenceError, p.UnresolvedReferenceError):
+            self.assertTrue(issubclass(error, p.PropertiesError))
+        self.assertTrue(issubclass(ParseError, SyntaxError))
+        self.assertTrue(issubclass(p.CyclicReferenceError, ValueError))
+        e = PropertiesTest.__getExceptionFromCall(p.Properties().load, PropertiesTest.getInputStream('=value'))
+        self.assertTrue(isinstance(e, p.PropertiesError))
+        diff = p.PropertiesDiff(frozenset(['a']), frozenset(), frozenset(['b']))
+        self.assertEqual((diff.added, diff.changed, diff.removed), (frozenset(['a']), frozenset(), frozenset(['b'])))
+        self.assertEqual(diff, (frozenset(['a']), frozenset(), frozenset(['b'])))
+
+    def testImportTime(self):
+        # The import is timed in fresh interpreters, the best of a few runs to leave out the noise of the machine.
+        script = ('import sys, time\n'
+                  'sys.path.insert(0, %r)\n'
+                  'before = set(sys.modules)\n'
+                  'start = time.time()\n'
+                  'import properties\n'
+                  'print time.time() - start\n'
+                  'print " ".join(sorted(set(sys.modules) - before))\n') % os.path.dirname(os.path.abspath(p.__file__))
+        runs = [subprocess.check_output([sys.executable, '-S', '-c', script]).splitlines() for _ in range(5)]
+        importTime = min(float(run[0]) for run in runs)
+        self.assertTrue(importTime <= IMPORT_TIME_BUDGET, 'Importing properties took %.1fms, the budget is %.1fms.' %
+                        (importTime * 1000, IMPORT_TIME_BUDGET * 1000))
+        imported = set(name.split('.')[0] for name in runs[0][1].split())
+        for module in ('configobj', 'reportlab', 'io', 'multiprocessing', 'pprint', 'threading', 'xml'):
+            self.assertFalse(module in imported, module + ' is imported along with properties.')
+
 if __name__ == "__main__":    
     unittest.main()
\ No newline at end of file